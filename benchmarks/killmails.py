@@ -0,0 +1,235 @@
+'''Synthetic zKillboard data for the benchmarks: pages of killmails shaped like
+/api/kills/allianceID/<id>/page/<n>/ and a local HTTP server that answers those URLs.
+
+    python benchmarks/killmails.py --alliances 10 --pages 20 --out /tmp/killmails
+
+writes one JSON file per page, which KillboardServer can serve instead of generating them.
+'''
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import threading
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# zKillboard returns up to 200 kills a page
+KILLS_PER_PAGE = 200
+
+# A few hulls fly far more than the rest, like on the real killboard
+SHIP_TYPES   = [580 + i for i in range(400)]
+WEAPON_TYPES = [2400 + i for i in range(150)]
+ITEM_TYPES   = [3000 + i for i in range(2000)]
+
+
+class Generator():
+    '''Deterministic for a given seed. Alliance IDs are the ones pages are asked for, every kill
+       on an alliance's pages has one of its pilots on it, as victim or attacker.'''
+
+    def __init__(self, alliances, days=60, kills_per_page=KILLS_PER_PAGE, pilots_per_alliance=500, seed=1, now=None):
+        self.alliances      = list(alliances)
+        self.days           = days
+        self.kills_per_page = kills_per_page
+        self.seed           = seed
+        self.pilots         = {}
+
+        # Kill times count back from now, so the views' "last N days" windows have data in them
+        self.now = now or datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+
+        rng = random.Random(seed)
+
+        # Other alliances show up on the killmails too
+        self.everyone = self.alliances + [98000000 + i for i in range(40)]
+        self.weights  = [1.0 / (rank + 1) for rank in range(len(SHIP_TYPES))]
+
+        for alliance_id in self.everyone:
+            corporations = [alliance_id * 10 + i for i in range(10)]
+            pilots       = []
+
+            for i in range(pilots_per_alliance):
+                corp_id = rng.choice(corporations)
+
+                pilots.append({'characterID':alliance_id * 1000 + i,
+                               'characterName':'Pilot %s-%s' % (alliance_id, i),
+                               'corporationID':corp_id,
+                               'corporationName':'Corp %s' % (corp_id),
+                               'allianceID':alliance_id,
+                               'allianceName':'Alliance %s' % (alliance_id)})
+
+            self.pilots[alliance_id] = pilots
+
+    def ship(self, rng):
+        return rng.choices(SHIP_TYPES, weights=self.weights)[0]
+
+    def pilot(self, rng, alliance_id):
+        return dict(rng.choice(self.pilots[alliance_id]))
+
+    def killmail(self, rng, alliance_id, kill_id, kill_time):
+        victim_side = rng.random() < 0.5
+        enemy       = rng.choice([other for other in self.everyone if other != alliance_id])
+
+        victim = self.pilot(rng, alliance_id if victim_side else enemy)
+        victim.update({'shipTypeID':self.ship(rng), 'damageTaken':rng.randint(1000, 500000)})
+
+        # Mostly small gangs, now and then a blob
+        count     = min(int(rng.paretovariate(1.2)), 250)
+        attackers = []
+
+        for i in range(count):
+            attacker = self.pilot(rng, enemy if victim_side else alliance_id)
+            attacker.update({'shipTypeID':self.ship(rng), 'weaponTypeID':rng.choice(WEAPON_TYPES),
+                             'damageDone':rng.randint(0, 20000), 'finalBlow':int(i == 0), 'securityStatus':0.0})
+            attackers.append(attacker)
+
+        items = [{'typeID':rng.choice(ITEM_TYPES), 'flag':rng.randint(0, 200), 'qtyDropped':rng.randint(0, 3),
+                  'qtyDestroyed':rng.randint(0, 3), 'singleton':0} for _ in range(rng.randint(3, 40))]
+
+        return {'killID':kill_id, 'solarSystemID':30000000 + rng.randint(0, 8000), 'killTime':kill_time.strftime(TIME_FORMAT),
+                'moonID':0, 'victim':victim, 'attackers':attackers, 'items':items}
+
+    def page(self, alliance_id, page, pages):
+        '''Page n of an alliance, newest kills on page 0 like zKillboard. pages is how many pages
+           the alliance has, kill times are spread over days across all of them.'''
+
+        if alliance_id not in self.alliances or page >= pages:
+            return []
+
+        rng   = random.Random('%s-%s-%s' % (self.seed, alliance_id, page))
+        span  = self.days * 86400.0 / (pages * self.kills_per_page)
+        index = self.alliances.index(alliance_id)
+        kills = []
+
+        for i in range(self.kills_per_page):
+            position  = page * self.kills_per_page + i
+            kill_time = self.now - datetime.timedelta(seconds=int(position * span))
+            # Unique across alliances, newest first within one
+            kill_id   = 50000000 + index * 10000000 + (pages * self.kills_per_page - position)
+            kills.append(self.killmail(rng, alliance_id, kill_id, kill_time))
+
+        return kills
+
+
+class KillboardHandler(BaseHTTPRequestHandler):
+    path_pattern = re.compile(r'/api/kills/allianceID/(\d+)/page/(\d+)/?$')
+
+    def do_GET(self):
+        match = self.path_pattern.match(self.path)
+
+        if not match:
+            self.send_error(404)
+            return
+
+        body = self.server.page_body(int(match.group(1)), int(match.group(2)))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class KillboardServer(ThreadingMixIn, HTTPServer):
+    '''Answers zKillboard's loss URLs on 127.0.0.1 from a Generator, or from the files
+       write_fixtures made. Pages are rendered once and kept, so every run serves the same bytes.'''
+
+    daemon_threads = True
+
+    def __init__(self, generator=None, pages=1, fixtures=None, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), KillboardHandler)
+
+        self.generator = generator
+        self.pages     = pages
+        self.fixtures  = fixtures
+        self.bodies    = {}
+        self.lock      = threading.Lock()
+        self.thread    = None
+
+    @property
+    def kb_url(self):
+        return 'http://127.0.0.1:%s/api/kills/allianceID/%%s/page/%%s/' % (self.server_address[1])
+
+    def page_body(self, alliance_id, page):
+        with self.lock:
+            if (alliance_id, page) not in self.bodies:
+                self.bodies[(alliance_id, page)] = self.render(alliance_id, page)
+
+            return self.bodies[(alliance_id, page)]
+
+    def warm(self, alliance_ids):
+        '''Renders every page up front, so a timed run measures Spearmint and not the generator.'''
+
+        for alliance_id in alliance_ids:
+            for page in range(self.pages):
+                self.page_body(alliance_id, page)
+
+    def render(self, alliance_id, page):
+        if self.fixtures:
+            path = fixture_path(self.fixtures, alliance_id, page)
+
+            if not os.path.exists(path):
+                return b'[]'
+
+            with open(path, 'rb') as page_file:
+                return page_file.read()
+
+        return json.dumps(self.generator.page(alliance_id, page, self.pages)).encode('utf-8')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def fixture_path(directory, alliance_id, page):
+    return os.path.join(directory, '%s-%s.json' % (alliance_id, page))
+
+
+def write_fixtures(generator, pages, directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    kills = 0
+
+    for alliance_id in generator.alliances:
+        for page in range(pages):
+            data = generator.page(alliance_id, page, pages)
+            kills += len(data)
+
+            with open(fixture_path(directory, alliance_id, page), 'w') as page_file:
+                json.dump(data, page_file)
+
+    return kills
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--alliances', help='alliances to generate pages for', type=int, default=10)
+    parser.add_argument('--pages',     help='pages per alliance', type=int, default=20)
+    parser.add_argument('--days',      help='days the kills are spread over', type=int, default=60)
+    parser.add_argument('--seed',      help='random seed', type=int, default=1)
+    parser.add_argument('--out',       help='directory to write the pages to', default='/tmp/killmails')
+    args = parser.parse_args()
+
+    generator = Generator([99000000 + i for i in range(args.alliances)], days=args.days, seed=args.seed)
+    kills     = write_fixtures(generator, args.pages, args.out)
+
+    print('Wrote %s kills over %s pages to %s' % (kills, args.alliances * args.pages, args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+'''Times the LossesUtils queries behind /statistics/ships before and after the losses indexes
+from `update.py --migrate` exist, and prints SQLite's query plan for each of them. The
+query_total_raw cases read attacker and kills directly, query_total reads whole days from the
+ship_usage_daily rollup, which is rebuilt from the generated losses.
+
+    python benchmarks/losses_indexes.py --attackers 1000000 --db /tmp/losses_bench.sqlite
+'''
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, event
+
+from spearmint_libs.sql import Base, migrate_sql
+from spearmint_libs.sql.losses import ItemsLost, Kills, Attacker, LossSync, ShipUsageDaily
+
+
+ALLIANCES  = [99000000 + i for i in range(60)]
+COALITION  = ALLIANCES[:10]
+SHIP_TYPES = [580 + i for i in range(300)]
+
+
+def populate(engine, attackers, seed=1):
+    random.seed(seed)
+
+    now        = datetime.datetime.utcnow()
+    kill_count = max(1, attackers // 8)
+    characters = max(100, attackers // 50)
+    chunk      = 50000
+
+    print('Generating %s kills and %s attackers...' % (kill_count, attackers))
+
+    def kill_time():
+        return now - datetime.timedelta(seconds=random.randint(0, 730 * 86400))
+
+    times = {}
+
+    with engine.begin() as conn:
+        for start in range(0, kill_count, chunk):
+            rows = []
+
+            for kill_id in range(start, min(start + chunk, kill_count)):
+                times[kill_id] = kill_time()
+                rows.append({'killID':kill_id,
+                             'shipTypeID':random.choice(SHIP_TYPES),
+                             'killTime':times[kill_id],
+                             'characterID':random.randint(1, characters),
+                             'corporationID':random.randint(1, 2000),
+                             'corporationName':'corp',
+                             'allianceID':random.choice(ALLIANCES)})
+
+            conn.execute(Kills.__table__.insert(), rows)
+
+        for start in range(0, attackers, chunk):
+            rows = []
+
+            for _ in range(start, min(start + chunk, attackers)):
+                kill_id = random.randint(0, kill_count - 1)
+                rows.append({'killID':kill_id,
+                             'killTime':times[kill_id],
+                             'weaponTypeID':random.choice(SHIP_TYPES),
+                             'allianceID':random.choice(ALLIANCES),
+                             'corporationName':'corp',
+                             'shipTypeID':random.choice(SHIP_TYPES),
+                             'characterName':'character',
+                             'characterID':random.randint(1, characters),
+                             'allianceName':'alliance'})
+
+            conn.execute(Attacker.__table__.insert(), rows)
+
+
+def drop_indexes(engine):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            engine.execute('DROP INDEX IF EXISTS %s' % (index.name))
+
+    engine.execute('ANALYZE')
+
+
+def run(losses, statements, rounds):
+    days_ago  = datetime.datetime.utcnow() - datetime.timedelta(days=20)
+    character = losses.db.engine.execute('SELECT characterID FROM attacker LIMIT 1').scalar()
+    ship      = SHIP_TYPES[0]
+
+    cases = [('query_total_raw used',       lambda: losses.query_total_raw(COALITION, days_ago=days_ago, kills='used')),
+             ('query_total_raw used character', lambda: losses.query_total_raw(COALITION, days_ago=days_ago, characterID=character, kills='used')),
+             ('query_total_raw lost',       lambda: losses.query_total_raw(COALITION, days_ago=days_ago, kills='lost')),
+             ('query_total used (rollup)',  lambda: losses.query_total(COALITION, days_ago=days_ago, kills='used')),
+             ('query used ship',            lambda: losses.query(COALITION, shipTypeID=ship, days_ago=days_ago, kills='used')),
+             ('query lost ship',            lambda: losses.query(COALITION, shipTypeID=ship, days_ago=days_ago, kills='lost')),
+             ('oldest_record',              lambda: losses.oldest_record(COALITION, 'lost'))]
+
+    results = {}
+
+    for name, case in cases:
+        del statements[:]
+        case()
+        plans = []
+
+        for statement, parameters in list(statements):
+            plan = losses.db.engine.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            plans.extend(row[-1] for row in plan)
+
+        timings = []
+
+        for _ in range(rounds):
+            started = time.time()
+            case()
+            timings.append(time.time() - started)
+
+        results[name] = (min(timings), plans)
+
+    return results
+
+
+def report(label, results):
+    print()
+    print('== %s' % (label))
+
+    for name, (elapsed, plans) in results.items():
+        print('%-32s %9.2f ms' % (name, elapsed * 1000))
+
+        for plan in plans:
+            print('    %s' % (plan))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db',        help='sqlite file to build or reuse', default='/tmp/losses_bench.sqlite')
+    parser.add_argument('--attackers', help='attacker rows to generate', type=int, default=1000000)
+    parser.add_argument('--rounds',    help='timed runs per query, the best one is reported', type=int, default=3)
+    args = parser.parse_args()
+
+    url    = 'sqlite:///%s' % (os.path.abspath(args.db))
+    engine = create_engine(url)
+
+    if not os.path.exists(args.db) or not engine.has_table('attacker'):
+        Base.metadata.create_all(engine)
+        drop_indexes(engine)
+        populate(engine, args.attackers)
+
+    else:
+        # Adds ship_usage_daily to databases built before it
+        Base.metadata.create_all(engine)
+        drop_indexes(engine)
+
+    # Imported here so LossesUtils reflects the tables created above
+    from spearmint_libs.losses_utils import LossesUtils
+
+    losses     = LossesUtils({'database':{'data':url}})
+    statements = []
+
+    # populate only writes kills and attacker, query_total would read an empty rollup otherwise
+    started = time.time()
+
+    if losses.ensure_rollup():
+        print('Built ship_usage_daily in %.1fs' % (time.time() - started))
+
+    @event.listens_for(losses.db.engine, 'before_cursor_execute')
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith('EXPLAIN'):
+            statements.append((statement, parameters))
+
+    before = run(losses, statements, args.rounds)
+
+    started = time.time()
+    migrate_sql(engine)
+    engine.execute('ANALYZE')
+    print('Created indexes in %.1fs' % (time.time() - started))
+
+    # Pooled connections keep their prepared EXPLAINs, which would still show the plans from before
+    losses.db.engine.dispose()
+
+    after = run(losses, statements, args.rounds)
+
+    report('without indexes', before)
+    report('with indexes', after)
+
+    print()
+    print('%-32s %10s %10s %8s' % ('', 'before ms', 'after ms', 'speedup'))
+
+    for name in before:
+        print('%-32s %10.2f %10.2f %7.1fx' % (name, before[name][0] * 1000, after[name][0] * 1000, before[name][0] / max(after[name][0], 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
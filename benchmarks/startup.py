@@ -0,0 +1,104 @@
+'''Times opening the SDE the way Utils does, each in a fresh interpreter: reflecting every table
+(how Spearmint used to start), reflecting only SDE_TABLES, and loading the pickled schema. Total
+includes importing SQLAlchemy, connect is just Connect().
+
+    python benchmarks/startup.py --tables 400 --db /tmp/sde_bench.sqlite
+
+Point --db at a real SDE dump to time that instead, --tables is only used to build a synthetic one.
+'''
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SDE_SCHEMA = ['CREATE TABLE "invTypes" ("typeID" INTEGER PRIMARY KEY, "groupID" INTEGER, "typeName" VARCHAR(100), "description" TEXT, '
+              '"mass" FLOAT, "volume" FLOAT, "capacity" FLOAT, "portionSize" INTEGER, "raceID" INTEGER, "basePrice" DECIMAL(19,4), '
+              '"published" BOOLEAN, "marketGroupID" INTEGER, "iconID" INTEGER, "soundID" INTEGER, "graphicID" INTEGER)',
+              'CREATE TABLE "mapSolarSystems" ("solarSystemID" INTEGER PRIMARY KEY, "regionID" INTEGER, "constellationID" INTEGER, '
+              '"solarSystemName" VARCHAR(100), "security" FLOAT)',
+              'CREATE TABLE "mapDenormalize" ("itemID" INTEGER PRIMARY KEY, "typeID" INTEGER, "groupID" INTEGER, "solarSystemID" INTEGER, '
+              '"itemName" VARCHAR(100))',
+              'CREATE TABLE "planetSchematicsTypeMap" ("schematicID" INTEGER, "typeID" INTEGER, "quantity" INTEGER, "isInput" BOOLEAN, '
+              'PRIMARY KEY ("schematicID", "typeID"))']
+
+# Run in a child interpreter so every case starts without anything reflected
+CHILD = '''
+import sys, time
+sys.path.insert(0, %(root)r)
+started = time.time()
+from spearmint_libs.sql import db_connect
+from spearmint_libs.utils import SDE_TABLES
+connecting = time.time()
+db = db_connect.Connect(%(url)r, %(args)s)
+db.base.classes.invTypes
+print(time.time() - started, time.time() - connecting)
+'''
+
+
+def build(path, tables):
+    engine = create_engine('sqlite:///%s' % (path))
+
+    for statement in SDE_SCHEMA:
+        engine.execute(statement)
+
+    # Stand-ins for the rest of the dump, which Spearmint never reads
+    for i in range(tables):
+        engine.execute('CREATE TABLE "sdeTable%s" ("id" INTEGER PRIMARY KEY, "parentID" INTEGER, "name" VARCHAR(100), '
+                       '"description" TEXT, "value" FLOAT, "flag" BOOLEAN)' % (i))
+        engine.execute('CREATE INDEX "ix_sdeTable%s_parentID" ON "sdeTable%s" ("parentID")' % (i, i))
+
+
+def time_case(url, args, rounds):
+    child   = CHILD % {'root':ROOT, 'url':url, 'args':args}
+    timings = []
+
+    for _ in range(rounds):
+        output = subprocess.check_output([sys.executable, '-c', child])
+        timings.append(tuple(float(value) for value in output.decode('utf-8').split()))
+
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db',     help='sqlite file to build or reuse', default='/tmp/sde_bench.sqlite')
+    parser.add_argument('--tables', help='filler tables in the synthetic SDE', type=int, default=400)
+    parser.add_argument('--rounds', help='runs per case, the best one is reported', type=int, default=5)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print('Building a synthetic SDE with %s extra tables...' % (args.tables))
+        build(args.db, args.tables)
+
+    url       = 'sqlite:///%s' % (os.path.abspath(args.db))
+    cache_dir = tempfile.mkdtemp(prefix='spearmint-schema-bench-')
+
+    results = [('reflect every table',  time_case(url, '', args.rounds)),
+               ('reflect SDE_TABLES',   time_case(url, 'tables=SDE_TABLES', args.rounds))]
+
+    # The first run writes the pickle, the timed ones read it
+    cached = 'tables=SDE_TABLES, cache_schema=%r' % (cache_dir)
+
+    time_case(url, cached, 1)
+    results.append(('cached schema',    time_case(url, cached, args.rounds)))
+
+    baseline = results[0][1]
+
+    print()
+    print('%-24s %10s %12s %8s' % ('', 'total ms', 'connect ms', 'speedup'))
+
+    for name, (total, connect) in results:
+        print('%-24s %10.1f %12.1f %7.1fx' % (name, total * 1000, connect * 1000, baseline[0] / max(total, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+'''End to end benchmark: generates zKillboard pages, replays them through Command.update_losses
+from a local stand-in for zKillboard, then times the LossesUtils queries and the Flask views
+behind /statistics/ships. Results go to a JSON file, --compare prints the change against an
+earlier one.
+
+    python benchmarks/suite.py --alliances 10 --pages 20 --out results.json
+    python benchmarks/suite.py --alliances 10 --pages 20 --out new.json --compare results.json
+
+Everything lives in a temporary directory with its own config.json and databases. Without --sde
+a small SDE with just the ship types is made up, the views only need their names.
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import sqlalchemy
+
+from sqlalchemy import create_engine
+
+from killmails import Generator, KillboardServer, SHIP_TYPES
+from startup import SDE_SCHEMA
+
+
+ROOT      = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COALITION = 'Bench'
+
+
+def create_data_db(url):
+    # The models have to be imported for create_all to know about them
+    from spearmint_libs.sql import initialize_sql
+    from spearmint_libs.sql.losses import ItemsLost, Kills, LossSync, ShipUsageDaily
+    from spearmint_libs.sql.users  import Users, Character
+    from spearmint_libs.sql.pi     import Pi, PiSnapshot
+    from spearmint_libs.sql.names  import Names
+    from spearmint_libs.sql.mail   import EmailQueue
+
+    initialize_sql(create_engine(url))
+
+
+def create_sde(path):
+    engine = create_engine('sqlite:///%s' % (path))
+
+    for statement in SDE_SCHEMA:
+        engine.execute(statement)
+
+    engine.execute('INSERT INTO "invTypes" ("typeID", "typeName") VALUES (?, ?)',
+                   [(type_id, 'Ship %s' % (type_id)) for type_id in SHIP_TYPES])
+
+
+def write_config(workdir, alliances, kb_url, sde_url):
+    config = {'general':{'base_dir':workdir, 'cache_type':'simple', 'cache_local_size':10000, 'hostname':'localhost',
+                         'navbar_brand':'Bench', 'zkill_url':kb_url},
+              'email':{'from':'bench@localhost'},
+              'database':{'data':'sqlite:///%s/data.sqlite' % (workdir), 'ccp_dump':sde_url},
+              'coalitions':{COALITION:alliances},
+              'statistics':{'pi_systems':[], 'pi_tiers':[]},
+              'corp_api':{'key':'', 'code':''}}
+
+    path = os.path.join(workdir, 'config.json')
+
+    with open(path, 'w') as config_file:
+        json.dump(config, config_file, indent=4)
+
+    return path, config
+
+
+def timed(function, rounds):
+    '''Runs function rounds times after one untimed warm up run. Returns milliseconds.'''
+
+    function()
+    timings = []
+
+    for _ in range(rounds):
+        started = time.time()
+        function()
+        timings.append((time.time() - started) * 1000)
+
+    timings.sort()
+
+    return {'min_ms':round(timings[0], 3), 'median_ms':round(timings[len(timings) // 2], 3), 'rounds':rounds}
+
+
+def bench_ingest(config_path, config, pages, args):
+    from update import Command
+
+    # No action flags, so constructing it doesn't run anything
+    command = Command(['--workers', str(args.workers), '--batch-size', str(args.batch_size)], config_path)
+    command.args.losses = pages
+
+    started = time.time()
+    stats   = command.update_losses()
+    elapsed = time.time() - started
+
+    return {'seconds':round(elapsed, 3), 'pages':stats['pages'], 'kills':stats['kills'], 'rows':stats['rows'],
+            'failed':stats['failed'], 'kills_per_second':round(stats['kills'] / max(elapsed, 1e-9), 1),
+            'rows_per_second':round(stats['rows'] / max(elapsed, 1e-9), 1)}
+
+
+def bench_queries(config, rounds):
+    from spearmint_libs.losses_utils import LossesUtils
+
+    losses    = LossesUtils(config)
+    alliances = config['coalitions'][COALITION]
+    now       = datetime.datetime.utcnow()
+    character = losses.db.engine.execute('SELECT characterID FROM attacker LIMIT 1').scalar()
+    ship      = SHIP_TYPES[0]
+    results   = {}
+
+    cases = [('query_total used 20d',           lambda: losses.query_total(alliances, days_ago=now - datetime.timedelta(days=20), kills='used')),
+             ('query_total lost 20d',           lambda: losses.query_total(alliances, days_ago=now - datetime.timedelta(days=20), kills='lost')),
+             ('query_total used 60d',           lambda: losses.query_total(alliances, days_ago=now - datetime.timedelta(days=60), kills='used')),
+             ('query_total used character 20d', lambda: losses.query_total(alliances, characterID=character, days_ago=now - datetime.timedelta(days=20), kills='used')),
+             ('query_total_raw used 20d',       lambda: losses.query_total_raw(alliances, days_ago=now - datetime.timedelta(days=20), kills='used')),
+             ('query used ship 20d',            lambda: losses.query(alliances, shipTypeID=ship, days_ago=now - datetime.timedelta(days=20), kills='used')),
+             ('query lost ship 20d',            lambda: losses.query(alliances, shipTypeID=ship, days_ago=now - datetime.timedelta(days=20), kills='lost')),
+             ('query_page used ship 20d',       lambda: losses.query_page(alliances, shipTypeID=ship, days_ago=now - datetime.timedelta(days=20), kills='used')),
+             ('oldest_record used',             lambda: losses.oldest_record(alliances, 'used')),
+             ('oldest_record lost',             lambda: losses.oldest_record(alliances, 'lost'))]
+
+    for name, case in cases:
+        results[name] = timed(case, rounds)
+        losses.db.session.remove()
+
+    return results
+
+
+def bench_views(workdir, rounds):
+    # main reads config.json from the working directory
+    os.chdir(workdir)
+
+    import main
+
+    main.app.config['LOGIN_DISABLED'] = True
+    main.app.config['TESTING']        = True
+
+    client  = main.app.test_client()
+    ship    = 'Ship %s' % (SHIP_TYPES[0])
+    results = {}
+
+    urls = [('/statistics/ships used 20d',      '/statistics/ships?coalition=%s&days=20&kills=used' % (COALITION)),
+            ('/statistics/ships lost 20d',      '/statistics/ships?coalition=%s&days=20&kills=lost' % (COALITION)),
+            ('/statistics/ships_details 20d',   '/statistics/ships_details?coalition=%s&days=20&kills=used&ship=%s' % (COALITION, ship)),
+            ('/statistics/ships_details.json',  '/statistics/ships_details.json?coalition=%s&days=20&kills=used&ship=%s&draw=1&start=0&length=100' % (COALITION, ship)),
+            ('/statistics/export.csv 20d',      '/statistics/export.csv?coalition=%s&days=20&kills=used&ship=%s' % (COALITION, ship))]
+
+    for name, url in urls:
+        def request():
+            response = client.get(url)
+            response.get_data()
+
+            if response.status_code != 200:
+                raise RuntimeError('%s answered %s' % (url, response.status_code))
+
+        results[name] = timed(request, rounds)
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode('utf-8').strip()
+
+    except Exception:
+        return None
+
+
+def compare(results, previous_path):
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)
+
+    print()
+    print('%-36s %12s %12s %8s' % ('', 'before ms', 'after ms', 'change'))
+
+    for section in ('queries', 'views'):
+        for name, timing in results.get(section, {}).items():
+            before = previous.get(section, {}).get(name)
+
+            if not before:
+                continue
+
+            change = (timing['median_ms'] - before['median_ms']) / max(before['median_ms'], 1e-9) * 100
+            print('%-36s %12.2f %12.2f %+7.1f%%' % (name, before['median_ms'], timing['median_ms'], change))
+
+    if 'ingest' in previous and 'ingest' in results:
+        print('%-36s %12.1f %12.1f' % ('ingest kills/sec', previous['ingest']['kills_per_second'], results['ingest']['kills_per_second']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--alliances',  help='alliances in the coalition', type=int, default=10)
+    parser.add_argument('--pages',      help='zKillboard pages per alliance, 200 kills each', type=int, default=20)
+    parser.add_argument('--days',       help='days the kills are spread over', type=int, default=60)
+    parser.add_argument('--seed',       help='random seed for the killmails', type=int, default=1)
+    parser.add_argument('--workers',    help='--workers for update.py', type=int, default=4)
+    parser.add_argument('--batch-size', help='--batch-size for update.py', type=int, default=1000)
+    parser.add_argument('--rounds',     help='timed runs per query and view', type=int, default=5)
+    parser.add_argument('--sde',        help='sqlite SDE dump to use instead of a made up one', action='store')
+    parser.add_argument('--skip-views', help="don't time the Flask views", action='store_true')
+    parser.add_argument('--out',        help='file to write the results to', default='benchmark_results.json')
+    parser.add_argument('--compare',    help='earlier results file to compare with', action='store')
+    args = parser.parse_args()
+
+    out       = os.path.abspath(args.out)
+    workdir   = tempfile.mkdtemp(prefix='spearmint-bench-')
+    alliances = [99000000 + i for i in range(args.alliances)]
+
+    print('Working in %s' % (workdir))
+
+    if args.sde:
+        sde_url = 'sqlite:///%s' % (os.path.abspath(args.sde))
+
+    else:
+        create_sde(os.path.join(workdir, 'sde.sqlite'))
+        sde_url = 'sqlite:///%s/sde.sqlite' % (workdir)
+
+    generator = Generator(alliances, days=args.days, seed=args.seed)
+    server    = KillboardServer(generator, pages=args.pages).start()
+
+    print('Generating %s pages...' % (args.alliances * args.pages))
+    server.warm(alliances)
+
+    config_path, config = write_config(workdir, alliances, server.kb_url, sde_url)
+    create_data_db(config['database']['data'])
+
+    results = {'meta':{'date':datetime.datetime.utcnow().isoformat(' '), 'commit':git_commit(),
+                       'python':platform.python_version(), 'sqlalchemy':sqlalchemy.__version__,
+                       'args':vars(args)}}
+
+    print('Replaying through update.py...')
+    results['ingest'] = bench_ingest(config_path, config, args.pages, args)
+    server.stop()
+
+    print('Timing queries...')
+    results['queries'] = bench_queries(config, args.rounds)
+
+    if not args.skip_views:
+        print('Timing views...')
+        results['views'] = bench_views(workdir, args.rounds)
+
+    with open(out, 'w') as out_file:
+        json.dump(results, out_file, indent=4, sort_keys=True)
+
+    print()
+    print('Ingested %(kills)s kills (%(rows)s rows) in %(seconds)ss, %(kills_per_second)s kills/sec' % results['ingest'])
+
+    for section in ('queries', 'views'):
+        for name, timing in sorted(results.get(section, {}).items()):
+            print('%-36s %10.2f ms' % (name, timing['median_ms']))
+
+    print('Results written to %s' % (out))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
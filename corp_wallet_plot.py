@@ -1,16 +1,16 @@
 import evelink.api
 
-import main
 import datetime
 
 import plotly.plotly as py
 from plotly.graph_objs import *
 
-py.sign_in('username', 'password')
+from spearmint_libs.app_utils import load_config
 
-config = main.app.config
+py.sign_in('username', 'password')
 
-eve = evelink.eve.EVE()
+# Only the config is needed, importing main would set up the whole web app
+config = load_config('config.json')
 
 corp_api = evelink.api.API(api_key=(config['corp_api']['key'], config['corp_api']['code']))
 corp     = evelink.corp.Corp(corp_api)
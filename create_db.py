@@ -1,9 +1,22 @@
-import main
+from sqlalchemy import create_engine
 
+from spearmint_libs.app_utils import load_config
+from spearmint_libs.losses_utils import LossesUtils
 
-with main.app.app_context():
-    main.db.create_all()
+# You must import the models before create_all, otherwise it will create a db with no tables
+from spearmint_libs.sql import initialize_sql
+from spearmint_libs.sql.losses import ItemsLost, Kills, LossSync, ShipUsageDaily
+from spearmint_libs.sql.users  import Users, Character
+from spearmint_libs.sql.pi     import Pi, PiSnapshot
+from spearmint_libs.sql.names  import Names
+from spearmint_libs.sql.mail   import EmailQueue
 
-from spearmint_libs import pi
-p = pi.Pi(main.app.config, main.utils)
-pi.Base.metadata.create_all(p.store_engine)
+
+# Goes straight to the database, importing main would need it to exist already
+config = load_config('config.json')
+
+initialize_sql(create_engine(config['database']['data']))
+
+# create_all leaves ship_usage_daily empty on a database that already has losses
+if LossesUtils(config).ensure_rollup():
+    print('Built ship_usage_daily from the existing losses')
@@ -8,7 +8,7 @@ import hashlib
 
 from urllib.parse import quote
 from functools    import wraps
-from flask import Flask, render_template, request, redirect, session, url_for, escape, Response 
+from flask import Flask, render_template, request, redirect, session, url_for, escape, Response, jsonify
 from flask.ext.login import LoginManager, login_user, logout_user, current_user, login_required
 from flask.ext.cache import Cache
 
@@ -22,17 +22,21 @@ import requests
 
 from spearmint_libs.utils import Utils, format_time, format_currency, generate_code
 from spearmint_libs.pi_utils    import PiUtils
+from spearmint_libs.pi_profit   import PiProfit
 from spearmint_libs.losses_utils import LossesUtils
 from spearmint_libs.auth  import Auth
 from spearmint_libs.user_utils  import User
 from spearmint_libs.emailtools import EmailTools
+from spearmint_libs.names_utils import NamesUtils
+from spearmint_libs.cache_utils import CacheUtils
+from spearmint_libs.snapshot_utils import SnapshotUtils
+from spearmint_libs.app_utils import Lazy, CorpSheet, load_config
+from spearmint_libs.export_utils import EXPORT_FORMATS, export_chunks
+from spearmint_libs.metrics_utils import MetricsUtils
+from spearmint_libs.sql.db_connect import remove_sessions
 
 
-with open("config.json") as cfg:
-    config = json.loads(cfg.read())
-
-assert(config)
-
+config = load_config('config.json')
 
 db_path = config['database']['data'].split(':')[-1]
 
@@ -40,9 +44,8 @@ if not os.path.exists(db_path):
     print('Database at %s does not exist' % (db_path))
     exit()
 
-eve = evelink.eve.EVE()
-emailtools = EmailTools(config)
-
+# Nothing below talks to CCP or opens a database at import, the API clients, database handles and
+# corp sheet are created the first time they're used
 app = Flask(__name__)
 app.config.update(config)
 
@@ -51,62 +54,114 @@ app.config['SECRET_KEY']              = os.urandom(1488)
 app.config['SQLALCHEMY_DATABASE_URI'] = app.config['database']['data']
 app.config['log_path'] = '%s/log' % (app.config['general']['base_dir'])
 
+logging.basicConfig(filename=app.config['log_path'], level=logging.DEBUG)
+
 login_manager  = LoginManager()
 login_manager.login_view = 'login'
 login_manager.init_app(app)
 
-logging.basicConfig(filename=app.config['log_path'], level=logging.DEBUG)
+cache = Cache(app, config={'CACHE_DIR':'%s/cache' % (app.config['general']['base_dir']),
+                           'CACHE_DEFAULT_TIMEOUT':30 * 86400,
+                           'CACHE_TYPE': app.config['general']['cache_type']})
 
-# Setup the corp api object and get the corp ID
-corp_api   = evelink.api.API(api_key=(app.config['corp_api']['key'], app.config['corp_api']['code']))
-corp       = evelink.corp.Corp(corp_api)
-corp_sheet = corp.corporation_sheet()[0]
-app.config['corp_id']   = corp_sheet['id']
-app.config['corp_name'] = corp_sheet['name']
+# Off unless config.json has "metrics":{"enabled":true}
+metrics = MetricsUtils(config.get('metrics', {}), config['general']['base_dir'])
+metrics.init_app(app)
 
+# Charges template time to the request when metrics are on
+render_template = metrics.timed_template(render_template)
 
-utils =  Utils(app.config)
-losses = LossesUtils(app.config)
-pi    =  PiUtils(app.config, utils)
-cache =  Cache(app,config={'CACHE_DIR':'%s/cache' % (app.config['general']['base_dir']), 
-                           'CACHE_DEFAULT_TIMEOUT':10000000000000000,
-                           'CACHE_TYPE': app.config['general']['cache_type']})
+# Sends whatever was left in the email queue by the last run
+app.before_first_request(lambda: emailtools.start())
+
+
+def create_snapshots():
+    # Corp pages are served from the last API result, refreshed in the background at cachedUntil
+    snapshots = SnapshotUtils('%s/snapshots' % (config['general']['base_dir']))
+    snapshots.register('npc_standings', corp.npc_standings)
+    snapshots.register('wallet_transactions', corp.wallet_transactions)
+    snapshots.register('contracts', corp.contracts)
+
+    return snapshots
+
+
+def create_corp():
+    corp_api = evelink.api.API(api_key=(config['corp_api']['key'], config['corp_api']['code']))
 
+    return evelink.corp.Corp(corp_api)
 
 
+# None of these do anything until they're first used
+eve        = Lazy(evelink.eve.EVE)
+corp       = Lazy(create_corp)
+utils      = Lazy(lambda: Utils(config))
+losses     = Lazy(lambda: LossesUtils(config))
+pi         = Lazy(lambda: PiUtils(config, utils))
+pi_profit  = Lazy(lambda: PiProfit(pi, utils))
+names      = Lazy(lambda: NamesUtils(config, eve, corp))
+user       = Lazy(lambda: User(config))
+snapshots  = Lazy(create_snapshots)
+emailtools = Lazy(lambda: EmailTools(config))
 
-@cache.memoize()
+metrics.gauge('email_queue', 'Emails in the outbound queue by status.', 'status', lambda: emailtools.queue_depth())
+
+memo = CacheUtils(cache, maxsize=config['general'].get('cache_local_size', 10000),
+                  on_count=metrics.count_cache if metrics.enabled else None)
+
+# Per function lookups reach /debug/metrics through on_count, the local tier's size and evictions here
+metrics.gauge('memo_local', 'Entries, capacity and evictions of the in-process memo cache.', 'stat',
+              lambda: dict((stat, value) for stat, value in memo.stats().items() if stat != 'functions'))
+
+# Names hardly ever change, affiliations do
+NAME_TTL        = 30 * 86400
+AFFILIATION_TTL = 86400
+
+
+
+
+# The names table is filled from killmails by update.py, so most of these never reach the API
+@memo.memoize(NAME_TTL)
 def character_name_from_id(id_):
-    return eve.character_name_from_id(id_)[0]
+    return names.character_name(id_) or eve.character_name_from_id(id_)[0]
 
 # Insecure?
-@cache.memoize()
+@memo.memoize(NAME_TTL)
 def character_id_from_name(name):
     return eve.character_ids_from_names([name])[0][name]
 
-@cache.memoize()
+@memo.memoize(AFFILIATION_TTL)
 def corp_name_from_character_id(id_):
+    stored = names.corp_name_for_character(id_)
+
+    if stored:
+        return stored
+
     corp_name = eve.affiliations_for_characters(id_)
     return corp_name[0][id_]['name']
 
 
-@cache.memoize()
+@memo.memoize(AFFILIATION_TTL)
 def alliance_id_from_corp_id(corp_id):
+    stored = names.alliance_name_for_corp(corp_id)
+
+    if stored:
+        return stored
+
     sheet = corp.corporation_sheet(corp_id=corp_id)
     
     return sheet[0]['alliance']['name']
 
 
-
 app.jinja_env.filters['format_time'] = format_time
 app.jinja_env.filters['format_currency'] = format_currency
 app.jinja_env.filters['character_name_from_id'] = character_name_from_id
 app.jinja_env.filters['corp_name_from_character_id'] = corp_name_from_character_id
 app.jinja_env.filters['alliance_id_from_corp_id'] = alliance_id_from_corp_id
-app.jinja_env.filters['lookup_typename'] = utils.lookup_typename
+app.jinja_env.filters['lookup_typename'] = lambda type_id: utils.lookup_typename(type_id)
 app.jinja_env.filters['quote'] = quote
 
-user = User(config)
+corp_sheet = CorpSheet(corp, '%s/corp_sheet.json' % (config['general']['base_dir']))
+
 
 class RegisterForm(Form):
     keyid = TextField('KeyID')
@@ -136,6 +191,12 @@ def check_auth(email, password):
     return False
 
 
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    # Sessions are per thread, don't let the next request on this thread inherit this one's
+    remove_sessions()
+
+
 @login_manager.user_loader 
 def load_user(id):
     return user.load_user(id) or None
@@ -224,7 +285,7 @@ def register():
 
             # Remove characters that are not in the corp.
             for c in char_copy:
-                if char_copy[c]['corp']['id'] != app.config['corp_id']:
+                if char_copy[c]['corp']['id'] != corp_sheet.id:
                     # Remove from the original dictionary.
                     logging.info('[register] removing character: %s' % (characters.result[c]))
                     del characters.result[c]
@@ -273,22 +334,21 @@ def confirm_register():
                 api_key_id=session['api_key_id'],
                 api_code=session['api_code'],
                 active=False,
-                activation_code=activation_code)
+                activation_code=activation_code,
+                in_corp=True,
+                api_valid=True,
+                api_checked=datetime.datetime.utcnow())
      
-        for character_id in session['characters']:
-            logging.info('Adding character %s to %s, result %s' % (character_id, email, user.add_character(email, character_id)))
+        for character_id, character in session['characters'].items():
+            logging.info('Adding character %s to %s, result %s' % (character_id, email, user.add_character(email, character_id,
+                         name=character['name'], corp_id=character['corp']['id'])))
 
         activation_link = 'http://%s/activate_account?activation_code=%s&email=%s' % (config['general']['hostname'], activation_code, email)
 
-        try:
-            emailtools.send_email(to=email, 
-                                  subject='Activate your account', 
-                                  body=activation_link)
-
-        except ConnectionRefusedError:
-            logging.warn('error sending email, make sure the MTA is runnnig')
-
-            return info('Unable to send email, contact the admin', home_button=True)
+        # Queued, the MTA being down only delays it
+        emailtools.send_email(to=email, 
+                              subject='Activate your account', 
+                              body=activation_link)
 
         return render_template('submitted_register.html')
 
@@ -305,15 +365,10 @@ def email_reset_password():
         if not email:
             return render_template('info.html', info='Missing email')
 
-        query = user.lookup
-        if not query:
-            return render_template('info.html', info='User not found')
-
         recovery_code = generate_code() 
-        query.recovery_code = recovery_code
-        query.recovery_timestamp = datetime.datetime.now()
 
-        db.session.commit()
+        if not user.set_recovery_code(email, recovery_code):
+            return render_template('info.html', info='User not found')
 
         recovery_link = 'http://%s/password_recovery?recovery_code=%s&email=%s' % (config['general']['hostname'], recovery_code, email)
 
@@ -370,8 +425,7 @@ def user_change_password():
             return render_template('info.html', info='Passwords do not match')
             
         auth = Auth(current_user.user.email, password)
-        current_user.user.password = auth.pw_hash
-        db.session.commit()
+        user.set_password(current_user.user.email, auth.pw_hash)
 
         return render_template('info.html', info='Password successfully updated.')
 
@@ -383,19 +437,11 @@ def activate_account():
     email = request.args.get('email')
     activation_code  = request.args.get('activation_code')
 
-    query = User.query.filter_by(email=email).first()  
-
-    if not query or not email or not activation_code:
+    if not email or not activation_code:
         return render_template('info.html', info='There is an issue trying to activate your account, please contact the admin.')
 
-    # See if the activation code matches, and if it does "activate" the account, and set the previously used
-    # code to 'NULL'
-    if activation_code == query.activation_code and query.activation_code != 'NULL':
-        query.activation_code = 'NULL'
-        query.active = True
-        query.activation_timestamp = datetime.datetime.now()
-        db.session.commit()
-
+    # Also drops the cached copy load_user keeps, so the next request sees the account as active
+    if user.activate(email, activation_code):
         return render_template('info.html', info='Your account has been activated')
     
     return render_template('info.html', info='Invalid activation code or email')
@@ -412,11 +458,28 @@ def statistics_pi(tier):
         data = pi.get_prices(tier, system.solarSystemID)
 
         if data:
-            results[system.solarSystemName.lower()] = {"data":data, "cached_time":data[0].date}
+            results[system.solarSystemName.lower()] = {"data":data, "cached_time":data[0].date,
+                                                       "history":pi.get_price_history(tier, system.solarSystemID)}
 
     return render_template('statistics/pi.html', results=results)
 
 
+@app.route('/statistics/pi/profit', methods=['GET'])
+@login_required
+def statistics_pi_profit():
+    systems = []
+
+    for system_name in config['statistics']['pi_systems']:
+        system = utils.lookup_system(system_name)
+
+        if system:
+            systems.append(system)
+
+    results = pi_profit.evaluate([system.solarSystemID for system in systems], config['statistics']['pi_tiers'])
+
+    return render_template('statistics/pi_profit.html', systems=systems, results=results)
+
+
 @app.route('/corp/index', methods=['GET'])
 @login_required
 def corp_index():
@@ -426,73 +489,181 @@ def corp_index():
 @app.route('/corp/standings', methods=['GET'])
 @login_required
 def corp_standings():
-    return render_template('corp/standings.html', standings=corp.npc_standings())
+    snapshot = snapshots.get('npc_standings')
+
+    return render_template('corp/standings.html', standings=snapshot.data, snapshot=snapshot)
 
 
 @app.route('/corp/wallet_transactions',  methods=['GET'])
 @login_required
 def corp_transactions():
-    return render_template('corp/wallet_transactions.html', wallet_transactions=corp.wallet_transactions())
+    snapshot = snapshots.get('wallet_transactions')
+
+    return render_template('corp/wallet_transactions.html', wallet_transactions=snapshot.data, snapshot=snapshot)
 
 @app.route('/corp/contracts', methods=['GET'])
 @login_required
 def corp_contracts():
-    contracts = corp.contracts()[0]
+    snapshot  = snapshots.get('contracts')
+    contracts = snapshot.data[0]
 
-    return render_template('corp/contracts.html', contracts=contracts)
+    return render_template('corp/contracts.html', contracts=contracts, snapshot=snapshot)
 
 
 
-@app.route('/statistics/ships_details', methods=['GET'])
-@login_required
-def statistics_ships_details():
+def ships_details_args(args):
+    '''Reads the filters shared by ships_details and its JSON feed. Returns (filters, error).'''
+
     days = 20
     character_id = None
+    ship_name    = None
+    ship_id      = None
     kill_options = ['used','lost','killed']
 
-    if 'days' in request.args:
+    if 'days' in args:
         try:
-            days = int(request.args.get('days'))
+            days = int(args.get('days'))
         except:
-            return info('Incorrect amount of days entered')
+            return None, 'Incorrect amount of days entered'
 
-    if 'ship' in request.args:
-        ship_name = request.args.get('ship')
+    if 'ship' in args:
+        ship_name = args.get('ship')
         ship_id   = utils.lookup_typeid(ship_name)
 
         if not ship_id:
-            info('Ship not found') 
+            return None, 'Ship not found'
 
-    if 'character' in request.args:
-        character = request.args.get('character')
+    if 'character' in args:
+        character = args.get('character')
         if character != 'all':
             try:
-                character_id = int(character_id_from_name(request.args.get('character')))
+                character_id = int(character_id_from_name(args.get('character')))
             except:
-                return info('Unable to find character')
+                return None, 'Unable to find character'
 
 
-    kill_option = request.args.get('kills')
-    coalition = request.args.get('coalition')
+    kill_option = args.get('kills')
+    coalition = args.get('coalition')
 
     if kill_option not in kill_options:
         kill_option = 'used'
 
-    if 'coalition' not in request.args:
+    if 'coalition' not in args:
         coalition = list(config['coalitions'].keys())[0]
 
     if coalition in config['coalitions']:
         alliance_ids = config['coalitions'][coalition]
 
     else:
-        return info('Incorrect coalition')
+        return None, 'Incorrect coalition'
 
-    current_time = datetime.datetime.utcnow() 
-    days_ago     = current_time - datetime.timedelta(days=days) 
-    
-    query = losses.query(alliance_ids, characterID=character_id, shipTypeID=ship_id, days_ago=days_ago, kills=kill_option)
-    
-    return render_template('statistics/ships_details.html', coalition=coalition, data=query, ship_name=ship_name, ship_id=ship_id, kills=kill_option)
+    days_ago = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+    return {'days':days, 'days_ago':days_ago, 'ship_name':ship_name, 'ship_id':ship_id, 'character_id':character_id,
+            'kills':kill_option, 'coalition':coalition, 'alliance_ids':alliance_ids}, None
+
+
+@app.route('/statistics/ships_details', methods=['GET'])
+@login_required
+def statistics_ships_details():
+    filters, error = ships_details_args(request.args)
+
+    if error:
+        return info(error)
+
+    # The rows themselves come from statistics_ships_details_json, a page at a time
+    return render_template('statistics/ships_details.html', coalition=filters['coalition'], ship_name=filters['ship_name'],
+                           ship_id=filters['ship_id'], kills=filters['kills'],
+                           feed_url=url_for('statistics_ships_details_json', **request.args.to_dict()),
+                           csv_url=url_for('statistics_export', export_format='csv', **request.args.to_dict()),
+                           ndjson_url=url_for('statistics_export', export_format='ndjson', **request.args.to_dict()))
+
+
+@app.route('/statistics/ships_details.json', methods=['GET'])
+@login_required
+def statistics_ships_details_json():
+    '''DataTables server-side feed for ships_details. Besides DataTables' own parameters it takes
+       after, the cursor handed out with the previous page, so paging forward follows the index.'''
+
+    filters, error = ships_details_args(request.args)
+
+    if error:
+        return jsonify(error=error)
+
+    draw   = request.args.get('draw', 0, type=int)
+    start  = max(request.args.get('start', 0, type=int), 0)
+    length = min(max(request.args.get('length', 100, type=int), 1), 1000)
+    search = request.args.get('search[value]', '').strip() or None
+
+    # DataTables sends the index of the column to sort on, in the template's column order
+    columns    = ['killTime', None, 'corporationName', None, 'killID']
+    column     = request.args.get('order[0][column]', 0, type=int)
+    order_by   = columns[column] if 0 <= column < len(columns) and columns[column] else 'killTime'
+    descending = request.args.get('order[0][dir]', 'desc') != 'asc'
+
+    # Only good for the sort it was made for, anything else falls back to an offset
+    after = None
+
+    try:
+        cursor = json.loads(request.args.get('after') or 'null')
+
+        if cursor and cursor[:2] == [order_by, descending]:
+            after = (datetime.datetime.strptime(cursor[2], '%Y-%m-%d %H:%M:%S') if order_by == 'killTime' else cursor[2], cursor[3])
+
+    except (ValueError, TypeError, IndexError):
+        after = None
+
+    query = dict(characterID=filters['character_id'], shipTypeID=filters['ship_id'], days_ago=filters['days_ago'], kills=filters['kills'])
+
+    rows, next_after = losses.query_page(filters['alliance_ids'], search=search, order_by=order_by, descending=descending,
+                                         after=after, offset=start, limit=length, **query)
+
+    total    = losses.query_count(filters['alliance_ids'], **query)
+    filtered = losses.query_count(filters['alliance_ids'], search=search, **query) if search else total
+
+    # Only the names this page shows that its rows don't carry, attacker rows name themselves
+    resolved = names.resolve(character_ids=[row['characterID'] for row in rows if not row['characterName']],
+                             corporation_ids=[row['corporationID'] for row in rows if not row['allianceName']])
+
+    data = []
+
+    for row in rows:
+        data.append([row['killTime'].strftime('%Y-%m-%d %H:%M:%S'),
+                     row['allianceName'] or resolved.alliance_for_corp(row['corporationID']),
+                     row['corporationName'],
+                     row['characterName'] or resolved.character(row['characterID']),
+                     row['killID']])
+
+    if next_after:
+        value      = next_after[0].strftime('%Y-%m-%d %H:%M:%S') if order_by == 'killTime' else next_after[0]
+        next_after = json.dumps([order_by, descending, value, next_after[1]])
+
+    return jsonify(draw=draw, start=start, recordsTotal=total, recordsFiltered=filtered, data=data, next=next_after)
+
+
+@app.route('/statistics/export.<export_format>', methods=['GET'])
+@login_required
+def statistics_export(export_format):
+    '''Streams every row behind ships_details, same filters, as CSV or NDJSON. items=1 exports
+       the items lost on those kills instead.'''
+
+    if export_format not in EXPORT_FORMATS:
+        return info('Unknown export format')
+
+    filters, error = ships_details_args(request.args)
+
+    if error:
+        return info(error)
+
+    items = request.args.get('items') == '1'
+
+    columns, rows = losses.export_rows(filters['alliance_ids'], characterID=filters['character_id'], shipTypeID=filters['ship_id'],
+                                       days_ago=filters['days_ago'], kills=filters['kills'], items=items)
+
+    filename = '%s-%s-%sd.%s' % (filters['coalition'], 'items' if items else filters['kills'], filters['days'], export_format)
+
+    return Response(export_chunks(export_format, columns, rows), mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition':'attachment; filename="%s"' % (filename)})
 
 
 @app.route('/statistics/ships', methods=['GET'])
@@ -555,9 +726,11 @@ def statistics_ships():
     else:
         days_stored = 'N/A'
 
+    ship_names = utils.lookup_typenames([ship[0] for ship in query])
+
     for ship in query:
 
-        ship_name = utils.lookup_typename(ship[0]) or 'NA'
+        ship_name = ship_names.get(ship[0]) or 'NA'
         total_ships_lost += ship[1]
 
         if ship_name not in ships_lost:
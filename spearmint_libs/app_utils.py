@@ -0,0 +1,82 @@
+import os
+import json
+import logging
+import threading
+
+
+def load_config(path='config.json'):
+    with open(path) as cfg:
+        config = json.loads(cfg.read())
+
+    assert(config)
+
+    return config
+
+
+class Lazy():
+    '''Stands in for the object factory() returns, which is only built the first time one of its
+       attributes is used. Lets main.py hand out API clients and database handles at import time
+       without connecting to anything.'''
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._value   = None
+        self._loaded  = False
+        self._lock    = threading.Lock()
+
+    def _load(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._value  = self._factory()
+                    self._loaded = True
+
+        return self._value
+
+    def __getattr__(self, name):
+        # Only reached for names the proxy itself doesn't have, which includes its own before
+        # __init__ has run (copy and pickle create instances without calling it)
+        if name in ('_factory', '_value', '_loaded', '_lock'):
+            raise AttributeError(name)
+
+        return getattr(self._load(), name)
+
+
+class CorpSheet():
+    '''ID and name of the corp the API key belongs to. Fetched from the API the first time they're
+       needed and kept in a JSON file afterwards, delete the file to fetch them again.'''
+
+    def __init__(self, corp, path):
+        self.corp  = corp
+        self.path  = path
+        self.sheet = None
+        self.lock  = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.sheet is not None:
+                return self.sheet
+
+            if os.path.exists(self.path):
+                with open(self.path) as sheet_file:
+                    self.sheet = json.load(sheet_file)
+
+                return self.sheet
+
+            sheet      = self.corp.corporation_sheet()[0]
+            self.sheet = {'id':sheet['id'], 'name':sheet['name']}
+
+            with open(self.path, 'w') as sheet_file:
+                json.dump(self.sheet, sheet_file)
+
+            logging.info('[CorpSheet] stored the corporation sheet for %s in %s' % (self.sheet['name'], self.path))
+
+            return self.sheet
+
+    @property
+    def id(self):
+        return self.load()['id']
+
+    @property
+    def name(self):
+        return self.load()['name']
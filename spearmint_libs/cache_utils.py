@@ -0,0 +1,219 @@
+import os
+import time
+import pickle
+import logging
+import threading
+
+from collections import OrderedDict
+from functools   import wraps
+
+
+class LRUCache():
+    '''Small in-process cache with a size cap and per-entry expiry. Thread safe.'''
+
+    def __init__(self, maxsize=10000):
+        self.maxsize   = maxsize
+        self.entries   = OrderedDict()
+        self.lock      = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        '''Returns (found, value).'''
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return False, None
+
+            value, expires = entry
+
+            if expires < time.time():
+                del self.entries[key]
+                return False, None
+
+            self.entries.move_to_end(key)
+
+            return True, value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CacheUtils():
+    '''Two tier memoization: an LRUCache in this process in front of the shared Flask-Cache backend,
+       which is only read on a local miss and only written on a full miss.'''
+
+    def __init__(self, backend, maxsize=10000, on_count=None):
+        self.backend  = backend
+        self.local    = LRUCache(maxsize)
+        self.lock     = threading.Lock()
+        self.counters = {}
+        # Called with (function name, counter) on every lookup, see MetricsUtils.count_cache
+        self.on_count = on_count
+
+    def count(self, name, counter):
+        with self.lock:
+            counters = self.counters.setdefault(name, {'local_hits':0, 'shared_hits':0, 'misses':0})
+            counters[counter] += 1
+
+        if self.on_count:
+            self.on_count(name, counter)
+
+    def memoize(self, ttl):
+        '''Caches the decorated function's result for ttl seconds in both tiers. None results
+           aren't cached, so a failed lookup is retried next time.'''
+
+        def decorator(function):
+            name = function.__name__
+
+            @wraps(function)
+            def wrapper(*args):
+                key = 'memoize:%s:%r' % (name, args)
+
+                found, value = self.local.get(key)
+
+                if found:
+                    self.count(name, 'local_hits')
+                    return value
+
+                value = self.backend.get(key)
+
+                if value is not None:
+                    self.count(name, 'shared_hits')
+                    self.local.set(key, value, ttl)
+                    return value
+
+                self.count(name, 'misses')
+                value = function(*args)
+
+                if value is not None:
+                    self.backend.set(key, value, timeout=ttl)
+                    self.local.set(key, value, ttl)
+
+                return value
+
+            return wrapper
+
+        return decorator
+
+    def stats(self):
+        '''Lookups per function since the process started, and the state of the local tier.'''
+
+        with self.lock:
+            counters = dict((name, dict(values)) for name, values in self.counters.items())
+
+        return {'functions':counters, 'local_size':len(self.local), 'local_maxsize':self.local.maxsize,
+                'evictions':self.local.evictions}
+
+
+def read_cache_file(path):
+    '''Returns the expiry timestamp werkzeug's FileSystemCache wrote at the start of the file, 0 means
+       it never expires. Returns None for files that aren't cache entries.'''
+
+    # werkzeug keeps its entry count in a file of its own
+    if os.path.basename(path).startswith('__wz_cache'):
+        return None
+
+    try:
+        with open(path, 'rb') as cache_file:
+            expires = pickle.load(cache_file)
+
+    except Exception:
+        return None
+
+    if not isinstance(expires, (int, float)):
+        return None
+
+    return expires
+
+
+def inspect_cache_dir(path):
+    stats = {'files':0, 'bytes':0, 'expired':0, 'unreadable':0, 'oldest':None, 'newest':None}
+    now   = time.time()
+
+    if not os.path.isdir(path):
+        return stats
+
+    for name in os.listdir(path):
+        file_path = os.path.join(path, name)
+
+        if not os.path.isfile(file_path):
+            continue
+
+        expires = read_cache_file(file_path)
+        mtime   = os.path.getmtime(file_path)
+
+        stats['files'] += 1
+        stats['bytes'] += os.path.getsize(file_path)
+
+        if expires is None:
+            stats['unreadable'] += 1
+
+        elif expires != 0 and expires < now:
+            stats['expired'] += 1
+
+        stats['oldest'] = min(stats['oldest'] or mtime, mtime)
+        stats['newest'] = max(stats['newest'] or mtime, mtime)
+
+    return stats
+
+
+def prune_cache_dir(path, max_age=None, max_files=None):
+    '''Removes expired entries, entries written more than max_age seconds ago and, past max_files,
+       the least recently written ones. Returns the number of files removed.'''
+
+    now     = time.time()
+    kept    = []
+    removed = 0
+
+    if not os.path.isdir(path):
+        return 0
+
+    for name in os.listdir(path):
+        file_path = os.path.join(path, name)
+
+        if not os.path.isfile(file_path):
+            continue
+
+        expires = read_cache_file(file_path)
+        mtime   = os.path.getmtime(file_path)
+
+        # Leave anything we can't read alone
+        if expires is None:
+            continue
+
+        if (expires != 0 and expires < now) or (max_age and mtime < now - max_age):
+            os.remove(file_path)
+            removed += 1
+
+        else:
+            kept.append((mtime, file_path))
+
+    if max_files is not None and len(kept) > max_files:
+        kept.sort()
+
+        for mtime, file_path in kept[:len(kept) - max_files]:
+            os.remove(file_path)
+            removed += 1
+
+    logging.info('[prune_cache_dir] removed %s files from %s' % (removed, path))
+
+    return removed
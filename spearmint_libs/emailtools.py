@@ -1,24 +1,215 @@
-
+import time
 import smtplib
+import logging
+import datetime
+import threading
+
 from email.mime.text import MIMEText
 
+from sqlalchemy import select, and_, func
+
+from spearmint_libs.sql.db_connect import Connect
+from spearmint_libs.sql.mail import EmailQueue
+
 
 class EmailTools():
-    def __init__(self, config):
-        self.config = config
+    '''Outbound mail. send_email only writes the message to the email_queue table; a background
+       thread delivers it over one SMTP connection that's kept open while there's mail to send,
+       and retries failures with exponential backoff until max_attempts.
 
+       Several processes can drain the same queue: a message is claimed by moving its
+       next_attempt forward by claim_timeout, so one whose sender died goes out again later.'''
+
+    def __init__(self, config, max_attempts=8, retry=60, max_retry=3600, claim_timeout=600, idle_timeout=30, batch_size=50):
+        self.config        = config
+        self.smtp_host     = config['email'].get('smtp_host', 'localhost')
+        self.smtp_port     = config['email'].get('smtp_port', 25)
+        self.smtp_timeout  = config['email'].get('smtp_timeout', 30)
+        self.max_attempts  = max_attempts
+        self.retry         = retry
+        self.max_retry     = max_retry
+        self.claim_timeout = claim_timeout
+        self.idle_timeout  = idle_timeout
+        self.batch_size    = batch_size
+        self.db            = Connect(config['database']['data'])
+        self.smtp          = None
+        self.smtp_used     = 0
+        self.lock          = threading.Lock()
+        self.wakeup        = threading.Event()
+        self.thread        = None
+
+    def ensure_table(self):
+        EmailQueue.__table__.create(self.db.engine, checkfirst=True)
 
     def send_email(self, to, subject, body):
-        msg = MIMEText(body)
-        msg['Subject']    = subject
+        '''Queues a message and returns its id, delivery happens in the background.'''
+
+        queue = EmailQueue.__table__
+        now   = datetime.datetime.utcnow()
+
+        with self.db.engine.begin() as conn:
+            message_id = conn.execute(queue.insert(), {'recipient':to, 'subject':subject, 'body':body, 'status':'queued',
+                                                       'attempts':0, 'created':now, 'next_attempt':now}).inserted_primary_key[0]
+
+        logging.info('[emailtools] queued message %s to %s' % (message_id, to))
+
+        self.start()
+        self.wakeup.set()
+
+        return message_id
+
+    def message(self, row):
+        msg = MIMEText(row['body'])
+        msg['Subject']    = row['subject']
         msg['From']       = self.config['email']['from']
-        msg['To']         = to
-        msg['Body']       = body
+        msg['To']         = row['recipient']
         msg['Precedence'] = 'bulk'
         msg['Auto-Submitted'] = 'auto-generated'
-        s = smtplib.SMTP('localhost')
-        s.sendmail(msg['From'], msg['To'], msg.as_string())
-        s.quit()
 
+        return msg
+
+    def connection(self):
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=self.smtp_timeout)
+
+        self.smtp_used = time.time()
+
+        return self.smtp
+
+    def disconnect(self):
+        if self.smtp is None:
+            return
+
+        try:
+            self.smtp.quit()
+
+        except Exception:
+            pass
+
+        self.smtp = None
+
+    def deliver(self, row):
+        msg = self.message(row)
+
+        try:
+            self.connection().sendmail(msg['From'], [row['recipient']], msg.as_string())
+
+        except smtplib.SMTPServerDisconnected:
+            # The MTA dropped an idle connection, one retry on a fresh one
+            self.disconnect()
+            self.connection().sendmail(msg['From'], [row['recipient']], msg.as_string())
+
+    def backoff(self, attempts):
+        return min(self.retry * 2 ** (attempts - 1), self.max_retry)
+
+    def claim(self, conn, row, now):
+        '''Takes a due message for this process. False if another one got to it first.'''
+
+        queue = EmailQueue.__table__
+
+        result = conn.execute(queue.update().where(and_(queue.c.id == row['id'], queue.c.status == 'queued',
+                              queue.c.next_attempt == row['next_attempt'])).values(
+                              next_attempt=now + datetime.timedelta(seconds=self.claim_timeout), attempts=queue.c.attempts + 1))
+
+        return result.rowcount == 1
+
+    def send_queued(self):
+        '''Delivers every message that's due. Returns (sent, failed).'''
+
+        queue  = EmailQueue.__table__
+        sent   = 0
+        failed = 0
+
+        while True:
+            now = datetime.datetime.utcnow()
+
+            rows = self.db.engine.execute(select([queue]).where(and_(queue.c.status == 'queued', queue.c.next_attempt <= now)).order_by(
+                   queue.c.next_attempt).limit(self.batch_size)).fetchall()
+
+            if not rows:
+                return sent, failed
+
+            for row in rows:
+                with self.db.engine.begin() as conn:
+                    if not self.claim(conn, row, now):
+                        continue
+
+                attempts = row['attempts'] + 1
+
+                try:
+                    self.deliver(row)
+
+                except Exception as ex:
+                    self.disconnect()
+                    failed += 1
+
+                    values = {'last_error':str(ex)[:255]}
+
+                    if attempts >= self.max_attempts:
+                        values['status'] = 'failed'
+                        logging.warning('[emailtools] giving up on message %s to %s: %s' % (row['id'], row['recipient'], ex))
+
+                    else:
+                        values['next_attempt'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.backoff(attempts))
+                        logging.warning('[emailtools] message %s to %s failed, attempt %s: %s' % (row['id'], row['recipient'], attempts, ex))
+
+                    self.db.engine.execute(queue.update().where(queue.c.id == row['id']).values(**values))
+                    continue
+
+                self.db.engine.execute(queue.update().where(queue.c.id == row['id']).values(status='sent', sent=datetime.datetime.utcnow()))
+                sent += 1
+
+    def next_due(self):
+        queue = EmailQueue.__table__
+
+        return self.db.engine.execute(select([func.min(queue.c.next_attempt)]).where(queue.c.status == 'queued')).scalar()
+
+    def queue_depth(self):
+        '''Returns {status: messages}, plus 'due' for the queued ones that could go out now.'''
+
+        queue = EmailQueue.__table__
+        depth = {'queued':0, 'sent':0, 'failed':0}
+
+        for status, count in self.db.engine.execute(select([queue.c.status, func.count()]).group_by(queue.c.status)):
+            depth[status] = count
+
+        depth['due'] = self.db.engine.execute(select([func.count()]).where(and_(queue.c.status == 'queued',
+                       queue.c.next_attempt <= datetime.datetime.utcnow()))).scalar()
+
+        return depth
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.ensure_table()
+
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                sent, failed = self.send_queued()
+
+                if sent or failed:
+                    logging.info('[emailtools] sent %s, failed %s, queue: %s' % (sent, failed, self.queue_depth()))
+
+                next_due = self.next_due()
+
+            except Exception as ex:
+                logging.warning('[emailtools] queue worker: %s' % (ex))
+                next_due = None
+
+            timeout = self.idle_timeout
+
+            if next_due is not None:
+                timeout = min(timeout, max(1, (next_due - datetime.datetime.utcnow()).total_seconds()))
+
+            if self.smtp is not None and time.time() - self.smtp_used >= self.idle_timeout:
+                self.disconnect()
 
-        
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
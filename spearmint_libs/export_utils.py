@@ -0,0 +1,60 @@
+import io
+import csv
+import json
+import datetime
+
+
+# Rows are written out this many at a time, so a response or file grows in chunks rather than
+# one line or the whole export at a time
+CHUNK_ROWS = 1000
+
+EXPORT_FORMATS = {'csv':'text/csv', 'ndjson':'application/x-ndjson'}
+
+
+def export_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat(' ') if isinstance(value, datetime.datetime) else value.isoformat()
+
+    return value
+
+
+def csv_chunks(columns, rows):
+    '''Yields CSV text, a header line first and then CHUNK_ROWS rows per chunk.'''
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(columns)
+
+    for i, row in enumerate(rows, 1):
+        writer.writerow([export_value(row[column]) for column in columns])
+
+        if i % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def ndjson_chunks(columns, rows):
+    '''Yields newline-delimited JSON, one object per row and CHUNK_ROWS rows per chunk.'''
+
+    lines = []
+
+    for row in rows:
+        lines.append(json.dumps(dict((column, export_value(row[column])) for column in columns)))
+
+        if len(lines) == CHUNK_ROWS:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def export_chunks(export_format, columns, rows):
+    if export_format == 'ndjson':
+        return ndjson_chunks(columns, rows)
+
+    return csv_chunks(columns, rows)
@@ -1,75 +1,565 @@
+import datetime
+import threading
+
 from spearmint_libs.sql.db_connect import Connect
-from sqlalchemy import func
+from spearmint_libs.sql.losses import Kills, Attacker, LossSync, ShipUsageDaily
+from spearmint_libs.sql.names  import Names
+from spearmint_libs.names_utils import store_names, killmail_names
+from sqlalchemy import func, select, and_, or_, literal, null, bindparam, String
+
+
+class LossQuery():
+    '''Builds one parameterized SELECT over attacker ('used'), kills ('lost'), with items the
+       items_lost rows joined to their kill, or with rollup the ship_usage_daily rows of either,
+       from whichever filters are given:
+
+       alliance_ids  allianceID IN (...)
+       characterID   characterID =
+       shipTypeID    shipTypeID =
+       since         killTime > (day > with rollup)
+       before        killTime < (day < with rollup)
+       search        corporationName, allianceName or the character's stored name contains it
+       after         (sort value, id) of the row the page starts after, needs keyset
+
+       columns are column names, 'count' for COUNT(*) or 'sum_count' for the rollup's SUM(count).
+       A name in null_columns that the table doesn't have is selected as NULL, so attacker and
+       kills rows come out with the same keys. keyset orders by order_by and then id, which is
+       what after pages through.
+
+       A statement is built once per shape (table, columns, filters given, grouping, ordering) and
+       only its parameters change, so with compiled_cache it's compiled once as well.'''
+
+    filters = ['alliance_ids', 'characterID', 'shipTypeID', 'since', 'before', 'search', 'after']
+
+    # Only one of attacker and kills has these
+    null_columns = ['allianceName', 'characterName', 'corporationID']
+
+    # What an items export shows, items_lost's own columns come first
+    item_columns = ['id', 'killID', 'typeID', 'killTime', 'shipTypeID', 'characterID', 'corporationID', 'corporationName', 'allianceID']
+
+    def __init__(self, classes):
+        self.classes        = classes
+        self.statements     = {}
+        self.compiled_cache = {}
+        self.lock           = threading.Lock()
+
+    def table(self, kills='used', rollup=False, items=False):
+        '''The table filters apply to, items filter on the kill.'''
+
+        if rollup:
+            return ShipUsageDaily.__table__
+
+        return self.classes.attacker.__table__ if kills == 'used' and not items else self.classes.kills.__table__
+
+    def column(self, table, name, items=None):
+        if name == 'count':
+            return func.count().label('count')
+
+        if name == 'sum_count':
+            return func.sum(table.c['count']).label('count')
+
+        if items is not None and name in items.c:
+            return items.c[name]
+
+        if name not in table.c and name in self.null_columns:
+            return null().label(name)
+
+        return table.c[name]
+
+    def sort(self, table, name, items=None):
+        column = self.column(table, name, items)
+
+        # A NULL name doesn't compare with anything, which would stop a keyset page at the first one
+        if isinstance(column.type, String):
+            return func.coalesce(column, '')
+
+        return column
+
+    def search(self, table):
+        names   = Names.__table__
+        pattern = bindparam('search')
+        matches = [table.c.corporationName.like(pattern),
+                   table.c.characterID.in_(select([names.c.entityID]).where(
+                   and_(names.c.kind == 'character', names.c.name.like(pattern))))]
+
+        if 'allianceName' in table.c:
+            matches.append(table.c.allianceName.like(pattern))
+
+        return or_(*matches)
+
+    def statement(self, kills, rollup, items, columns, filters, group_by, order_by, descending, keyset, limit, offset):
+        table  = self.table(kills, rollup, items)
+        source = self.classes.items_lost.__table__ if items else None
+        time   = table.c.day if rollup else table.c.killTime
+        where  = []
+
+        if rollup:
+            where.append(table.c.kill_option == bindparam('kill_option'))
+
+        if 'alliance_ids' in filters:
+            where.append(table.c.allianceID.in_(bindparam('alliance_ids', expanding=True)))
+
+        if 'characterID' in filters:
+            where.append(table.c.characterID == bindparam('characterID'))
+
+        if 'shipTypeID' in filters:
+            where.append(table.c.shipTypeID == bindparam('shipTypeID'))
+
+        if 'since' in filters:
+            where.append(time > bindparam('since'))
+
+        if 'before' in filters:
+            where.append(time < bindparam('before'))
+
+        if 'search' in filters:
+            where.append(self.search(table))
+
+        order = []
+
+        if order_by:
+            sort = self.sort(table, order_by, source) if keyset else self.column(table, order_by, source)
+            order.append(sort.desc() if descending else sort.asc())
+
+        if keyset:
+            id_ = self.column(table, 'id', source)
+            order.append(id_.desc() if descending else id_.asc())
+
+            if 'after' in filters:
+                value, after_id = bindparam('after_value'), bindparam('after_id')
+
+                if descending:
+                    where.append(or_(sort < value, and_(sort == value, id_ < after_id)))
+
+                else:
+                    where.append(or_(sort > value, and_(sort == value, id_ > after_id)))
+
+        query = select([self.column(table, name, source) for name in columns])
+
+        if items:
+            query = query.select_from(source.join(table, source.c.killID == table.c.killID))
+
+        else:
+            query = query.select_from(table)
+
+        if where:
+            query = query.where(and_(*where))
+
+        if group_by:
+            query = query.group_by(*[table.c[name] for name in group_by])
+
+        if order:
+            query = query.order_by(*order)
+
+        if limit:
+            query = query.limit(bindparam('limit'))
+
+        if offset:
+            query = query.offset(bindparam('offset'))
+
+        return query
+
+    def build(self, kills='used', columns=None, rollup=False, items=False, group_by=(), order_by=None, descending=False,
+              keyset=False, limit=None, offset=None, **filters):
+        '''Returns (statement, parameters). Filters left as None aren't applied.'''
+
+        unknown = set(filters) - set(self.filters)
+
+        if unknown:
+            raise TypeError('unknown filters: %s' % (', '.join(sorted(unknown))))
+
+        if filters.get('after') is not None and not (keyset and order_by):
+            raise TypeError('after needs keyset and order_by')
+
+        if not columns:
+            columns = self.item_columns if items else [column.name for column in self.table(kills, rollup).columns]
+
+        params  = dict((name, value) for name, value in filters.items() if value is not None)
+        given   = tuple(sorted(params))
+        columns = tuple(columns)
+        key     = (kills == 'used', rollup, items, columns, given, tuple(group_by), order_by, descending, keyset, bool(limit), bool(offset))
+
+        if 'alliance_ids' in params:
+            params['alliance_ids'] = list(params['alliance_ids'])
+
+        if 'search' in params:
+            params['search'] = '%%%s%%' % (params['search'].replace('%', '').replace('_', ''))
+
+        if 'after' in params:
+            params['after_value'], params['after_id'] = params.pop('after')
+
+        if rollup:
+            params['kill_option'] = 'used' if kills == 'used' else 'lost'
+
+        if limit:
+            params['limit'] = limit
+
+        if offset:
+            params['offset'] = offset
+
+        with self.lock:
+            if key not in self.statements:
+                self.statements[key] = self.statement(kills, rollup, items, columns, given, group_by, order_by, descending,
+                                                      keyset, limit, offset)
+
+            return self.statements[key], params
 
 
 class LossesUtils():
+    # What query_page can sort on, keyset pagination needs a column the database can order by
+    page_orders = ['killTime', 'corporationName', 'killID']
+
+    # The columns ships_details shows, the same keys for attacker and kills rows
+    page_columns = ['id', 'killTime', 'killID', 'allianceID', 'allianceName', 'corporationID', 'corporationName',
+                    'characterID', 'characterName']
+
     def __init__(self, config):
         self.db = Connect(config['database']['data'])
         self.classes = self.db.base.classes
+        self.loss_query = LossQuery(self.classes)
         
 
-    def oldest_record(self, alliance_ids, kills='kills'):
-        # Get the first killTime recorded
-        if kills == 'kills':
-                return self.db.session.query(self.classes.attacker.killTime).filter(self.classes.attacker.allianceID.in_(alliance_ids)).order_by(self.classes.attacker.killTime.asc()).first().killTime
+    def known_kill_ids(self, kill_ids, connection=None):
+        '''Returns the subset of kill_ids that are already stored, with one IN query per chunk.'''
+
+        kills = self.classes.kills.__table__
+        conn  = connection or self.db.engine
+        found = set()
 
-        return self.db.session.query(self.classes.kills.killTime).filter(self.classes.kills.allianceID.in_(alliance_ids)).order_by(self.classes.kills.killTime.asc()).first().killTime 
+        kill_ids = list(kill_ids)
 
+        # Stay under SQLite's 999 bound parameter limit
+        for i in range(0, len(kill_ids), 500):
+            chunk = kill_ids[i:i + 500]
+            query = select([kills.c.killID]).where(kills.c.killID.in_(chunk))
+            found.update(row[0] for row in conn.execute(query))
 
+        return found
 
-    def query_total(self, alliance_ids, characterID=None, days_ago=1000, kills='used'):
-        if kills == 'used' and characterID:
-            return self.db.session.query(self.classes.attacker.shipTypeID, func.count(self.classes.attacker.shipTypeID)).group_by(self.classes.attacker.shipTypeID).filter(
-                    self.classes.attacker.allianceID.in_(alliance_ids)).filter(self.classes.attacker.killTime > days_ago).filter_by(characterID=characterID).all()
-           
-        if kills == 'used':
-            return self.db.session.query(self.classes.attacker.shipTypeID, func.count(self.classes.attacker.shipTypeID)).group_by(self.classes.attacker.shipTypeID).filter(
-                    self.classes.attacker.allianceID.in_(alliance_ids)).filter(self.classes.attacker.killTime > days_ago).all()
+    def sync_state(self):
+        '''Returns the loss_sync rows keyed by allianceID.'''
 
+        sync_table = LossSync.__table__
 
-        if characterID:
-            return self.db.session.query(self.classes.kills.shipTypeID, func.count(self.classes.kills.shipTypeID)).filter(
-                    self.classes.kills.killTime > days_ago).group_by(self.classes.kills.shipTypeID).filter_by(characterID=characterID).filter(
-                            self.classes.kills.allianceID.in_(alliance_ids)).all()
+        return dict((row.allianceID, row) for row in self.db.engine.execute(select([sync_table])))
 
-        return self.db.session.query(self.classes.kills.shipTypeID, func.count(self.classes.kills.shipTypeID)).group_by(self.classes.kills.shipTypeID).filter(self.classes.kills.killTime > days_ago).filter(
-                self.db.base.classes.kills.allianceID.in_(alliance_ids)).all()
+    def update_sync(self, conn, sync):
+        '''Moves each alliance's high-water mark forward and records its last committed page.'''
 
+        sync_table  = LossSync.__table__
+        time_format = '%Y-%m-%d %H:%M:%S'
+        now         = datetime.datetime.utcnow()
 
-    def query(self, alliance_ids, characterID=None, shipTypeID=None, days_ago=1000, kills='used'):
+        for alliance_id, state in sync.items():
+            current = conn.execute(select([sync_table]).where(sync_table.c.allianceID == alliance_id)).first()
+            values  = {'updated':now}
 
-        if kills == 'used':
-            if characterID and shipTypeID:
-                return self.db.session.query(self.classes.attacker).filter(self.classes.attacker.killTime > days_ago).filter_by(characterID=characterID, shipTypeID=shipTypeID).filter(
-                        self.classes.attacker.allianceID.in_(alliance_ids)).all()
+            if state['killID'] is not None and (not current or current.killID is None or state['killID'] > current.killID):
+                values['killID']   = state['killID']
+                values['killTime'] = datetime.datetime.strptime(state['killTime'], time_format)
 
-            if characterID:
-                return self.db.session.query(self.classes.attacker).filter(self.classes.attacker.killTime > days_ago).filter_by(characterID=characterID).filter(
-                        self.classes.attacker.allianceID.in_(alliance_ids)).all()
+            if state['page'] is not None:
+                values['page'] = state['page']
 
-            if shipTypeID:
-                return self.db.session.query(self.classes.attacker).filter(self.classes.attacker.killTime > days_ago).filter_by(shipTypeID=shipTypeID).filter(
-                        self.classes.attacker.allianceID.in_(alliance_ids)).all()
+            if current:
+                conn.execute(sync_table.update().where(sync_table.c.allianceID == alliance_id), values)
 
             else:
-                return self.db.session.query(self.classes.attacker).filter(self.classes.attacker.killTime > days_ago).filter(
-                        self.classes.attacker.allianceID.in_(alliance_ids)).all()
+                values['allianceID'] = alliance_id
+                conn.execute(sync_table.insert(), values)
 
+    def store_kills(self, rows, sync=None):
+        '''Stores a batch of zKillboard kills (one or more pages) in a single transaction, skipping
+           the ones already in the database. sync is passed to update_sync inside the same
+           transaction. Returns (kills written, rows written).'''
 
+        time_format = '%Y-%m-%d %H:%M:%S'
+        batch       = {}
 
-        if characterID and shipTypeID:
-            return self.db.session.query(self.classes.kills).filter(self.classes.kills.killTime > days_ago).filter_by(characterID=characterID, shipTypeID=shipTypeID).filter(
-                    self.classes.kills.allianceID.in_(alliance_ids)).all()
+        for row in rows:
+            batch.setdefault(row['killID'], row)
 
-        if characterID:
-            return self.db.session.query(self.classes.kills).filter(self.classes.kills.killTime > days_ago).filter_by(characterID=characterID).filter(
-                    self.classes.kills.allianceID.in_(alliance_ids)).all()
+        if not batch and not sync:
+            return 0, 0
 
-        if shipTypeID:
-            return self.db.session.query(self.classes.kills).filter(self.classes.kills.killTime > days_ago).filter_by(shipTypeID=shipTypeID).filter(
-                    self.classes.kills.allianceID.in_(alliance_ids)).all()
-   
-        else:
-            return self.db.session.query(self.classes.kills).filter(self.classes.kills.killTime > days_ago).filter(
-                self.classes.kills.allianceID.in_(alliance_ids)).all()
+        kills_table     = self.classes.kills.__table__
+        attackers_table = self.classes.attacker.__table__
+        items_table     = self.classes.items_lost.__table__
+
+        with self.db.engine.begin() as conn:
+            # Names are worth refreshing even from kills we already have
+            store_names(conn, killmail_names(batch.values()))
+
+            for kill_id in self.known_kill_ids(batch.keys(), connection=conn):
+                del batch[kill_id]
+
+            kills     = []
+            attackers = []
+            items     = []
+
+            for kill_id, row in batch.items():
+                # 'killTime': '2014-09-19 21:27:00'
+                kill_time = datetime.datetime.strptime(row['killTime'], time_format)
+
+                kills.append({'killID':kill_id,
+                              'shipTypeID':row['victim']['shipTypeID'],
+                              'killTime':kill_time,
+                              'characterID':row['victim']['characterID'],
+                              'corporationID':row['victim']['corporationID'],
+                              'corporationName':row['victim']['corporationName'],
+                              'allianceID':row['victim']['allianceID']})
+
+                for line in row['items']:
+                    items.append({'killID':kill_id, 'typeID':line['typeID']})
+
+                for line in row['attackers']:
+                    attackers.append({'killID':kill_id,
+                                      'killTime':kill_time,
+                                      'weaponTypeID':line['weaponTypeID'],
+                                      'allianceID':line['allianceID'],
+                                      'corporationName':line['corporationName'],
+                                      'shipTypeID':line['shipTypeID'],
+                                      'characterName':line['characterName'],
+                                      'characterID':line['characterID'],
+                                      'allianceName':line['allianceName']})
+
+            # executemany, one statement per table for the whole batch
+            if kills:
+                conn.execute(kills_table.insert(), kills)
+
+            if attackers:
+                conn.execute(attackers_table.insert(), attackers)
+
+            if items:
+                conn.execute(items_table.insert(), items)
+
+            self.update_rollup(conn, self.rollup_rows(kills, attackers))
+
+            if sync:
+                self.update_sync(conn, sync)
+
+        return len(kills), len(kills) + len(attackers) + len(items)
+
+
+    def execute(self, statement, params):
+        '''Runs a LossQuery statement on the request's session, through the compiled statement cache.'''
+
+        conn = self.db.session.connection().execution_options(compiled_cache=self.loss_query.compiled_cache)
+
+        return conn.execute(statement, params)
+
+    def select(self, kills='used', **options):
+        '''LossQuery.build and execute in one, see LossQuery for the options.'''
+
+        return self.execute(*self.loss_query.build(kills, **options))
+
+    def oldest_record(self, alliance_ids, kills='used'):
+        '''The first killTime recorded, None if there isn't one.'''
+
+        return self.select(kills, columns=['killTime'], alliance_ids=alliance_ids, order_by='killTime', limit=1).scalar()
+
+    def query_total(self, alliance_ids, characterID=None, days_ago=None, kills='used'):
+        '''Returns (shipTypeID, count) rows for the window. Whole days come from the ship_usage_daily
+           rollup and only the partial day at the start of the window is counted from the raw
+           table, so the cost doesn't grow with the amount of history stored.'''
+
+        if 'ship_usage_daily' not in self.classes or (days_ago is not None and not isinstance(days_ago, datetime.datetime)):
+            return self.query_total_raw(alliance_ids, characterID=characterID, days_ago=days_ago, kills=kills)
+
+        totals = {}
+        since  = None
+
+        if days_ago is not None:
+            midnight = datetime.datetime.combine(days_ago.date() + datetime.timedelta(days=1), datetime.time())
+            since    = days_ago.date()
+
+            for ship, count in self.query_total_raw(alliance_ids, characterID=characterID, days_ago=days_ago, kills=kills, before=midnight):
+                totals[ship] = totals.get(ship, 0) + count
+
+        # day > the first, partial, day
+        rows = self.select(kills, rollup=True, columns=['shipTypeID', 'sum_count'], group_by=['shipTypeID'],
+                           alliance_ids=alliance_ids, characterID=characterID or None, since=since)
+
+        for ship, count in rows:
+            totals[ship] = totals.get(ship, 0) + count
+
+        return list(totals.items())
+
+    def query_total_raw(self, alliance_ids, characterID=None, days_ago=None, kills='used', before=None):
+        return self.select(kills, columns=['shipTypeID', 'count'], group_by=['shipTypeID'], alliance_ids=alliance_ids,
+                           characterID=characterID or None, since=days_ago, before=before).fetchall()
+
+    def rollup_rows(self, kills, attackers):
+        '''Turns kill and attacker rows into ship_usage_daily increments.'''
+
+        counts = {}
+
+        for option, rows in (('lost', kills), ('used', attackers)):
+            for row in rows:
+                key = (row['killTime'].date(), row['allianceID'], row['characterID'], row['shipTypeID'], option)
+                counts[key] = counts.get(key, 0) + 1
+
+        return counts
+
+    def rollup_ids(self, conn, keys):
+        '''{key: id} of the ship_usage_daily rows that already exist for keys, with a few IN
+           queries on day and characterID rather than one lookup per key.'''
+
+        rollup     = ShipUsageDaily.__table__
+        columns    = [rollup.c.id, rollup.c.day, rollup.c.allianceID, rollup.c.characterID, rollup.c.shipTypeID, rollup.c.kill_option]
+        days       = sorted(set(key[0] for key in keys))
+        characters = sorted(set(key[2] for key in keys if key[2] is not None))
+        found      = {}
+
+        # Stay under SQLite's 999 bound parameters, NPC rows have no characterID to match on
+        character_filters = [rollup.c.characterID.in_(characters[i:i + 400]) for i in range(0, len(characters), 400)]
+
+        if any(key[2] is None for key in keys):
+            character_filters.append(rollup.c.characterID == None)
+
+        for i in range(0, len(days), 100):
+            for character_filter in character_filters:
+                for row in conn.execute(select(columns).where(and_(rollup.c.day.in_(days[i:i + 100]), character_filter))):
+                    key = tuple(row)[1:]
+
+                    if key in keys:
+                        found[key] = row[0]
+
+        return found
+
+    def update_rollup(self, conn, counts):
+        '''Adds counts to ship_usage_daily: one executemany UPDATE for the keys that have a row and
+           one executemany INSERT for the rest. The key can hold NULLs (NPCs), which a unique index
+           never sees as conflicting, so existing rows are looked up rather than upserted.'''
+
+        if not counts:
+            return
+
+        rollup   = ShipUsageDaily.__table__
+        existing = self.rollup_ids(conn, counts)
+        updates  = []
+        inserts  = []
+
+        for key, count in counts.items():
+            if key in existing:
+                updates.append({'row_id':existing[key], 'increment':count})
+                continue
+
+            day, alliance_id, character_id, ship_type_id, option = key
+            inserts.append({'day':day, 'allianceID':alliance_id, 'characterID':character_id,
+                            'shipTypeID':ship_type_id, 'kill_option':option, 'count':count})
+
+        if updates:
+            conn.execute(rollup.update().where(rollup.c.id == bindparam('row_id')).values(count=rollup.c.count + bindparam('increment')), updates)
+
+        if inserts:
+            conn.execute(rollup.insert(), inserts)
+
+    def rebuild_rollup(self):
+        '''Recomputes ship_usage_daily from the full kills and attacker history.'''
+
+        rollup  = ShipUsageDaily.__table__
+        columns = ['day', 'allianceID', 'characterID', 'shipTypeID', 'kill_option', 'count']
+
+        with self.db.engine.begin() as conn:
+            conn.execute(rollup.delete())
+
+            for option, table in (('lost', self.classes.kills.__table__), ('used', self.classes.attacker.__table__)):
+                day   = func.date(table.c.killTime)
+                query = select([day, table.c.allianceID, table.c.characterID, table.c.shipTypeID, literal(option), func.count()]).group_by(
+                        day, table.c.allianceID, table.c.characterID, table.c.shipTypeID)
+
+                conn.execute(rollup.insert().from_select(columns, query))
+
+    def ensure_rollup(self):
+        '''Creates and fills ship_usage_daily on databases that predate it, or fills it when it's
+           empty while there are losses, which is what create_all leaves on such a database.
+           Returns True if it did.'''
+
+        rollup = ShipUsageDaily.__table__
+
+        if not rollup.exists(self.db.engine):
+            rollup.create(self.db.engine)
+
+        elif self.db.engine.execute(select([rollup.c.id]).limit(1)).first():
+            return False
+
+        if not any(self.db.engine.execute(select([table.c.id]).limit(1)).first()
+                   for table in (Kills.__table__, Attacker.__table__) if table.exists(self.db.engine)):
+            return False
+
+        self.rebuild_rollup()
+
+        return True
+
+
+    def query(self, alliance_ids, characterID=None, shipTypeID=None, days_ago=None, kills='used', columns=None,
+              order_by=None, descending=False, limit=None):
+        '''The attacker ('used') or kills rows in the window, every column unless columns names
+           the ones wanted.'''
+
+        return self.select(kills, columns=columns, alliance_ids=alliance_ids, characterID=characterID or None,
+                           shipTypeID=shipTypeID or None, since=days_ago, order_by=order_by, descending=descending,
+                           limit=limit).fetchall()
+
+    def query_count(self, alliance_ids, characterID=None, shipTypeID=None, days_ago=None, kills='used', search=None):
+        return self.select(kills, columns=['count'], alliance_ids=alliance_ids, characterID=characterID or None,
+                           shipTypeID=shipTypeID or None, since=days_ago, search=search).scalar()
+
+    def query_page(self, alliance_ids, characterID=None, shipTypeID=None, days_ago=None, kills='used', search=None,
+                   order_by='killTime', descending=True, after=None, offset=0, limit=100):
+        '''One page of the rows query returns, as dicts of page_columns rather than ORM objects.
+
+           after is the (sort value, id) of the last row of the previous page; when it's given the
+           page starts right after that row through the index instead of skipping offset rows.
+           Returns (rows, the after of the next page).'''
+
+        if order_by not in self.page_orders:
+            order_by = 'killTime'
+
+        rows = [dict(row) for row in self.select(kills, columns=self.page_columns, alliance_ids=alliance_ids,
+                characterID=characterID or None, shipTypeID=shipTypeID or None, since=days_ago, search=search,
+                order_by=order_by, descending=descending, keyset=True, after=after, limit=limit, offset=None if after else offset)]
+
+        if len(rows) < limit:
+            return rows, None
+
+        last  = rows[-1]
+        value = last[order_by]
+
+        if order_by == 'corporationName':
+            value = value or ''
+
+        return rows, (value, last['id'])
+
+    def export_rows(self, alliance_ids, characterID=None, shipTypeID=None, days_ago=None, kills='used', items=False,
+                    batch_size=1000):
+        '''Every row query would return, with all of its columns, in id order. items exports the
+           items lost on the kills instead, it always filters on the victim. Returns (column names,
+           a generator of row dicts); nothing is read until the generator is.'''
+
+        query, params = self.loss_query.build(kills, items=items, alliance_ids=alliance_ids, characterID=characterID or None,
+                                              shipTypeID=shipTypeID or None, since=days_ago, order_by='id')
+        names = query.c.keys()
+
+        return names, self.stream_rows(query, params, names, batch_size)
+
+    def stream_rows(self, query, params, names, batch_size=1000):
+        '''Reads through a server-side cursor batch_size rows at a time, so memory stays flat
+           however many rows there are. The connection is its own, not the request's session.'''
+
+        conn = self.db.engine.connect().execution_options(stream_results=True)
+
+        try:
+            result = conn.execute(query, params)
+
+            while True:
+                rows = result.fetchmany(batch_size)
+
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield dict(zip(names, row))
 
+        finally:
+            conn.close()
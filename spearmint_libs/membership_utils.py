@@ -0,0 +1,148 @@
+import datetime
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import evelink
+
+from sqlalchemy import select, bindparam, or_
+
+from spearmint_libs.sql import add_missing_columns
+from spearmint_libs.sql.db_connect import Connect
+from spearmint_libs.sql.users import Users, Character
+
+
+class KeyCheck():
+    '''What CCP said about one API key. characters is None when the key couldn't be checked.'''
+
+    def __init__(self, characters=None, expires=None, valid=True, error=None):
+        self.characters = characters
+        self.expires    = expires
+        self.valid      = valid
+        self.error      = error
+
+
+class MembershipUtils():
+    '''Re-checks the API keys users registered with. Every key is asked for its characters, up to
+       workers at a time and at most once per cachedUntil, then users and characters are updated in
+       one transaction. A user is in_corp while one of the key's characters is in corp_id; a key
+       CCP rejects counts as out of the corp.'''
+
+    # Characters are deleted and inserted this many users at a time
+    chunk_size = 500
+
+    def __init__(self, config, corp_id):
+        self.config  = config
+        self.corp_id = corp_id
+        self.db      = Connect(config['database']['data'])
+
+        # The statements below use the models, so the columns just have to exist
+        add_missing_columns(self.db.engine, Users.__table__)
+        add_missing_columns(self.db.engine, Character.__table__)
+
+    def users(self, force=False):
+        '''Users with a key whose cachedUntil has passed, or all of them with force.'''
+
+        users = Users.__table__
+        query = select([users.c.id, users.c.email, users.c.api_key_id, users.c.api_code]).where(users.c.api_key_id != None)
+
+        if not force:
+            query = query.where(or_(users.c.api_cached_until == None, users.c.api_cached_until <= datetime.datetime.utcnow()))
+
+        return self.db.engine.execute(query).fetchall()
+
+    def check_key(self, key_id, code):
+        account = evelink.account.Account(evelink.api.API(api_key=(key_id, code)))
+
+        try:
+            result = account.characters()
+
+        except evelink.api.APIError as ex:
+            # Deleted, expired or without the characters access mask
+            return KeyCheck(valid=False, error=str(ex))
+
+        except Exception as ex:
+            return KeyCheck(error=str(ex))
+
+        expires = datetime.datetime.utcfromtimestamp(result.expires) if result.expires else None
+
+        return KeyCheck(characters=result.result, expires=expires)
+
+    def check_keys(self, users, workers=8):
+        '''{(api_key_id, api_code): KeyCheck}, each distinct key asked for once.'''
+
+        keys   = set((user['api_key_id'], user['api_code']) for user in users)
+        checks = {}
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            jobs = dict((pool.submit(self.check_key, key_id, code), (key_id, code)) for key_id, code in keys)
+
+            for future in as_completed(jobs):
+                checks[jobs[future]] = future.result()
+
+        return checks
+
+    def sync(self, workers=8, force=False):
+        '''Checks the keys that are due and stores the results. Returns the counts, plus the emails
+           of the users found out of the corp in 'left'.'''
+
+        users  = self.users(force)
+        checks = self.check_keys(users, workers)
+        now    = datetime.datetime.utcnow().replace(microsecond=0)
+        stats  = {'users':len(users), 'keys':len(checks), 'in_corp':0, 'left':[], 'invalid':0, 'errors':0}
+
+        updates    = []
+        replace    = []
+        characters = []
+
+        for user in users:
+            check = checks[(user['api_key_id'], user['api_code'])]
+
+            if check.error and check.valid:
+                # Couldn't reach CCP, leave what's stored and try again next run
+                logging.warning('[membership] unable to check the key of %s: %s' % (user['email'], check.error))
+                stats['errors'] += 1
+                continue
+
+            in_corp = [character for character in (check.characters or {}).values() if character['corp']['id'] == self.corp_id]
+
+            updates.append({'user_id':user['id'], 'in_corp':bool(in_corp), 'api_valid':check.valid, 'api_checked':now,
+                            'api_cached_until':check.expires, 'api_error':check.error[:255] if check.error else None})
+
+            if not check.valid:
+                stats['invalid'] += 1
+
+            if in_corp:
+                stats['in_corp'] += 1
+                replace.append(user['id'])
+                characters.extend({'user_id':user['id'], 'character_id':character['id'], 'name':character['name'],
+                                   'corp_id':character['corp']['id']} for character in in_corp)
+
+            else:
+                # Their characters stay, so it's still known who they were
+                stats['left'].append(user['email'])
+
+        self.store(updates, replace, characters)
+
+        logging.info('[membership] checked %s keys of %s users, %s in the corp, %s out, %s invalid, %s errors' % (
+                     stats['keys'], stats['users'], stats['in_corp'], len(stats['left']), stats['invalid'], stats['errors']))
+
+        return stats
+
+    def store(self, updates, replace, characters):
+        users_table      = Users.__table__
+        characters_table = Character.__table__
+
+        update = users_table.update().where(users_table.c.id == bindparam('user_id')).values(
+                 in_corp=bindparam('in_corp'), api_valid=bindparam('api_valid'), api_checked=bindparam('api_checked'),
+                 api_cached_until=bindparam('api_cached_until'), api_error=bindparam('api_error'))
+
+        with self.db.engine.begin() as conn:
+            if updates:
+                conn.execute(update, updates)
+
+            for i in range(0, len(replace), self.chunk_size):
+                conn.execute(characters_table.delete().where(characters_table.c.user_id.in_(replace[i:i + self.chunk_size])))
+
+            if characters:
+                conn.execute(characters_table.insert(), characters)
@@ -0,0 +1,337 @@
+import os
+import hmac
+import glob
+import time
+import cProfile
+import logging
+import threading
+
+from functools import wraps
+from urllib.parse import urlparse
+
+import requests
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Upper bounds of the request duration histogram, in seconds
+BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# Outbound calls are labelled by the host they went to
+SERVICES = {'api.eveonline.com':'eve_api', 'zkillboard.com':'zkillboard', 'api.eve-central.com':'eve_central'}
+
+
+class RequestRecord():
+    '''What one request spent its time on, kept in a thread local while the request runs.'''
+
+    def __init__(self):
+        self.started  = time.time()
+        self.sql      = [0, 0.0]
+        self.outbound = {}
+        self.template = [0, 0.0]
+        self.cache    = {}
+        self.profiler = None
+
+
+class MetricsUtils():
+    '''Opt-in per-request instrumentation, enabled by "enabled": true in the "metrics" section of
+       config.json. Counts SQL on every engine, outbound HTTP calls, cache hits and template time
+       per request and per endpoint, serves the totals at /debug/metrics in Prometheus' text format,
+       and with the profile header set dumps a cProfile of that request to base_dir/profiles, keeping
+       the newest max_profiles of them.
+
+       Both need the request to come from an address in allow and to carry the configured token in
+       the token header; behind a reverse proxy every request comes from the proxy's address, so
+       without a token nothing is allowed.'''
+
+    def __init__(self, config, base_dir):
+        self.enabled        = bool(config.get('enabled', False))
+        self.allow          = config.get('allow', ['127.0.0.1', '::1'])
+        self.profile_header = config.get('profile_header', 'X-Spearmint-Profile')
+        self.profile_dir    = config.get('profile_dir', '%s/profiles' % (base_dir))
+        self.max_profiles   = config.get('max_profiles', 50)
+        self.token          = config.get('token') or None
+        self.token_header   = config.get('token_header', 'X-Spearmint-Metrics-Token')
+        self.local          = threading.local()
+        self.lock           = threading.Lock()
+        self.installed      = False
+
+        # endpoint -> totals, service -> totals
+        self.endpoints = {}
+        self.services  = {}
+        self.cache     = {}
+        self.gauges    = []
+
+    def current(self):
+        return getattr(self.local, 'record', None)
+
+    def install(self):
+        '''Hooks SQLAlchemy and requests, once per process.'''
+
+        if not self.enabled or self.installed:
+            return
+
+        # Every engine, so the ones Connect creates later are covered as well
+        event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+
+        requests.sessions.Session.request = self.wrap_request(requests.sessions.Session.request)
+
+        self.installed = True
+
+    def init_app(self, app):
+        if not self.enabled:
+            return
+
+        self.install()
+
+        if self.token is None:
+            logging.warning('[metrics] no token configured, /debug/metrics and profiling are disabled')
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.add_url_rule('/debug/metrics', 'debug_metrics', self.metrics_view)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.current() is not None:
+            conn.info.setdefault('metrics_started', []).append(time.time())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        record = self.current()
+
+        if record is None or not conn.info.get('metrics_started'):
+            return
+
+        record.sql[0] += 1
+        record.sql[1] += time.time() - conn.info['metrics_started'].pop()
+
+    def wrap_request(self, function):
+        metrics = self
+
+        @wraps(function)
+        def request(session, method, url, *args, **kwargs):
+            started = time.time()
+
+            try:
+                return function(session, method, url, *args, **kwargs)
+
+            finally:
+                metrics.record_outbound(url, time.time() - started)
+
+        return request
+
+    def record_outbound(self, url, elapsed):
+        host    = urlparse(url).hostname or 'unknown'
+        service = SERVICES.get(host, host)
+
+        with self.lock:
+            totals = self.services.setdefault(service, [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+
+        record = self.current()
+
+        if record is not None:
+            calls = record.outbound.setdefault(service, [0, 0.0])
+            calls[0] += 1
+            calls[1] += elapsed
+
+    def count_cache(self, name, counter):
+        '''CacheUtils' on_count callback.'''
+
+        with self.lock:
+            key = (name, counter)
+            self.cache[key] = self.cache.get(key, 0) + 1
+
+        record = self.current()
+
+        if record is not None:
+            record.cache[counter] = record.cache.get(counter, 0) + 1
+
+    def gauge(self, name, help_text, label, function):
+        '''Reports function()'s {label value: number} at /debug/metrics, read on every scrape.'''
+
+        self.gauges.append((name, help_text, label, function))
+
+    def timed_template(self, render):
+        '''Wraps render_template so its time is charged to the request.'''
+
+        if not self.enabled:
+            return render
+
+        metrics = self
+
+        @wraps(render)
+        def render_template(*args, **kwargs):
+            started = time.time()
+
+            try:
+                return render(*args, **kwargs)
+
+            finally:
+                record = metrics.current()
+
+                if record is not None:
+                    record.template[0] += 1
+                    record.template[1] += time.time() - started
+
+        return render_template
+
+    def allowed(self, request):
+        if self.token is None or request.remote_addr not in self.allow:
+            return False
+
+        return hmac.compare_digest(request.headers.get(self.token_header, '').encode('utf-8'), self.token.encode('utf-8'))
+
+    def before_request(self):
+        from flask import request
+
+        record = RequestRecord()
+        self.local.record = record
+
+        if request.headers.get(self.profile_header) and self.allowed(request):
+            record.profiler = cProfile.Profile()
+            record.profiler.enable()
+
+    def after_request(self, response):
+        from flask import request
+
+        record = self.current()
+        self.local.record = None
+
+        if record is None:
+            return response
+
+        elapsed  = time.time() - record.started
+        endpoint = request.endpoint or 'unknown'
+
+        if record.profiler is not None:
+            record.profiler.disable()
+            response.headers['X-Spearmint-Profile-File'] = self.dump_profile(record.profiler, endpoint)
+
+        with self.lock:
+            totals = self.endpoints.setdefault(endpoint, {'requests':{}, 'seconds':0.0, 'buckets':[0] * len(BUCKETS),
+                                                          'sql':[0, 0.0], 'outbound':[0, 0.0], 'template':[0, 0.0]})
+
+            status = str(response.status_code)
+            totals['requests'][status] = totals['requests'].get(status, 0) + 1
+            totals['seconds'] += elapsed
+
+            for i, bound in enumerate(BUCKETS):
+                if elapsed <= bound:
+                    totals['buckets'][i] += 1
+
+            for name, (count, seconds) in (('sql', record.sql), ('template', record.template),
+                                           ('outbound', [sum(calls[0] for calls in record.outbound.values()),
+                                                         sum(calls[1] for calls in record.outbound.values())])):
+                totals[name][0] += count
+                totals[name][1] += seconds
+
+        logging.info('[metrics] %s %s %.1fms, sql: %s in %.1fms, outbound: %s, template: %.1fms, cache: %s' % (
+                     endpoint, response.status_code, elapsed * 1000, record.sql[0], record.sql[1] * 1000,
+                     dict((service, '%s in %.1fms' % (calls[0], calls[1] * 1000)) for service, calls in record.outbound.items()),
+                     record.template[1] * 1000, record.cache))
+
+        return response
+
+    def dump_profile(self, profiler, endpoint):
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir, mode=0o700)
+
+        path = os.path.join(self.profile_dir, '%s-%s-%s.prof' % (time.strftime('%Y%m%d-%H%M%S'), endpoint, os.getpid()))
+        profiler.dump_stats(path)
+
+        self.prune_profiles()
+
+        return os.path.basename(path)
+
+    def prune_profiles(self):
+        '''Deletes all but the newest max_profiles dumps.'''
+
+        profiles = []
+
+        for path in glob.glob(os.path.join(self.profile_dir, '*.prof')):
+            try:
+                profiles.append((os.path.getmtime(path), path))
+
+            except OSError:
+                pass
+
+        for _, path in sorted(profiles, reverse=True)[self.max_profiles:]:
+            try:
+                os.remove(path)
+
+            except OSError:
+                # Another worker got to it first
+                pass
+
+    def metrics_view(self):
+        from flask import request, Response, abort
+
+        if not self.allowed(request):
+            abort(403)
+
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def render(self):
+        '''The totals in Prometheus' text exposition format.'''
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP spearmint_%s %s' % (name, help_text))
+            lines.append('# TYPE spearmint_%s %s' % (name, kind))
+
+            for suffix, labels, value in samples:
+                label_text = ','.join('%s="%s"' % (key, str(label).replace('\\', '\\\\').replace('"', '\\"')) for key, label in labels)
+                lines.append('spearmint_%s%s%s %s' % (name, suffix, '{%s}' % (label_text) if label_text else '', value))
+
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            services  = sorted(self.services.items())
+            cache     = sorted(self.cache.items())
+
+            metric('requests_total', 'counter', 'Requests served.',
+                   [('', [('endpoint', endpoint), ('status', status)], count)
+                    for endpoint, totals in endpoints for status, count in sorted(totals['requests'].items())])
+
+            samples = []
+
+            for endpoint, totals in endpoints:
+                count = sum(totals['requests'].values())
+
+                for bound, bucket in zip(BUCKETS, totals['buckets']):
+                    samples.append(('_bucket', [('endpoint', endpoint), ('le', bound)], bucket))
+
+                samples.append(('_bucket', [('endpoint', endpoint), ('le', '+Inf')], count))
+                samples.append(('_sum', [('endpoint', endpoint)], round(totals['seconds'], 6)))
+                samples.append(('_count', [('endpoint', endpoint)], count))
+
+            metric('request_duration_seconds', 'histogram', 'Wall time per request.', samples)
+
+            for name, what in (('sql', 'SQL statements'), ('outbound', 'outbound HTTP calls'), ('template', 'render_template calls')):
+                metric('%s_total' % (name), 'counter', 'Number of %s while serving requests.' % (what),
+                       [('', [('endpoint', endpoint)], totals[name][0]) for endpoint, totals in endpoints])
+                metric('%s_seconds_total' % (name), 'counter', 'Time spent in %s while serving requests.' % (what),
+                       [('', [('endpoint', endpoint)], round(totals[name][1], 6)) for endpoint, totals in endpoints])
+
+            metric('outbound_calls_total', 'counter', 'Outbound HTTP calls by service, background threads included.',
+                   [('', [('service', service)], totals[0]) for service, totals in services])
+            metric('outbound_call_seconds_total', 'counter', 'Time spent on outbound HTTP calls by service.',
+                   [('', [('service', service)], round(totals[1], 6)) for service, totals in services])
+
+            metric('cache_events_total', 'counter', 'Memoized lookups by function and outcome.',
+                   [('', [('function', name), ('outcome', counter)], count) for (name, counter), count in cache])
+
+        for name, help_text, label, function in self.gauges:
+            try:
+                values = function()
+
+            except Exception as ex:
+                logging.warning('[metrics] gauge %s: %s' % (name, ex))
+                continue
+
+            metric(name, 'gauge', help_text, [('', [(label, key)], value) for key, value in sorted(values.items())])
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,259 @@
+import datetime
+import logging
+
+from sqlalchemy import select, and_, bindparam
+
+from spearmint_libs.sql import add_missing_columns
+from spearmint_libs.sql.db_connect import Connect
+from spearmint_libs.sql.names import Names
+
+
+def store_names(conn, entries):
+    '''Upserts (entityID, kind, name, affiliationID, last_seen) tuples. An entry only replaces
+       what's stored when it was seen at the same time or later. The stored keys are read with one
+       IN query per kind and chunk, then the changes go out as one executemany UPDATE and INSERT.'''
+
+    table  = Names.__table__
+    now    = datetime.datetime.utcnow()
+    wanted = {}
+
+    for entry in entries:
+        key = (entry[1], entry[0])
+
+        if key not in wanted or wanted[key][4] <= entry[4]:
+            wanted[key] = entry
+
+    stored = {}
+
+    for kind in set(key[0] for key in wanted):
+        ids = [entity_id for key_kind, entity_id in wanted if key_kind == kind]
+
+        # Stay under SQLite's 999 bound parameter limit
+        for i in range(0, len(ids), 500):
+            query = select([table.c.id, table.c.entityID, table.c.last_seen]).where(
+                    and_(table.c.kind == kind, table.c.entityID.in_(ids[i:i + 500])))
+
+            for row in conn.execute(query):
+                stored[(kind, row.entityID)] = row
+
+    updates = []
+    inserts = []
+
+    for key, (entity_id, kind, name, affiliation_id, last_seen) in wanted.items():
+        values = {'name':name, 'affiliationID':affiliation_id, 'last_seen':last_seen, 'fetched':now}
+        row    = stored.get(key)
+
+        if row is None:
+            values.update({'entityID':entity_id, 'kind':kind})
+            inserts.append(values)
+
+        elif row.last_seen is None or row.last_seen <= last_seen:
+            values['row_id'] = row.id
+            updates.append(values)
+
+    if updates:
+        conn.execute(table.update().where(table.c.id == bindparam('row_id')), updates)
+
+    if inserts:
+        conn.execute(table.insert(), inserts)
+
+
+def killmail_names(rows):
+    '''Collects the names zKillboard puts on victims and attackers, keeping the newest sighting of
+       each entity.'''
+
+    time_format = '%Y-%m-%d %H:%M:%S'
+    seen        = {}
+
+    def add(entity_id, kind, name, affiliation_id, last_seen):
+        if not entity_id or not name:
+            return
+
+        if (kind, entity_id) not in seen or seen[(kind, entity_id)][4] < last_seen:
+            seen[(kind, entity_id)] = (entity_id, kind, name, affiliation_id or None, last_seen)
+
+    for row in rows:
+        kill_time = datetime.datetime.strptime(row['killTime'], time_format)
+
+        for line in [row['victim']] + row['attackers']:
+            add(line.get('characterID'), 'character', line.get('characterName'), line.get('corporationID'), kill_time)
+            add(line.get('corporationID'), 'corporation', line.get('corporationName'), line.get('allianceID'), kill_time)
+            add(line.get('allianceID'), 'alliance', line.get('allianceName'), None, kill_time)
+
+    return list(seen.values())
+
+
+class ResolvedNames():
+    '''What a view hands its template: plain dictionary lookups, no API calls.'''
+
+    def __init__(self, characters, corporations, alliances):
+        self.characters   = characters
+        self.corporations = corporations
+        self.alliances    = alliances
+
+    def character(self, character_id):
+        entry = self.characters.get(character_id)
+
+        return entry['name'] if entry else ''
+
+    def corporation(self, corp_id):
+        entry = self.corporations.get(corp_id)
+
+        return entry['name'] if entry else ''
+
+    def alliance(self, alliance_id):
+        entry = self.alliances.get(alliance_id)
+
+        return entry['name'] if entry else ''
+
+    def alliance_for_corp(self, corp_id):
+        entry = self.corporations.get(corp_id)
+
+        if not entry or not entry['affiliationID']:
+            return ''
+
+        return self.alliance(entry['affiliationID'])
+
+
+class NamesUtils():
+    # CharacterAffiliation takes a list of IDs, keep each call to a sane size
+    chunk_size = 100
+
+    def __init__(self, config, eve, corp, affiliation_ttl=86400):
+        self.db   = Connect(config['database']['data'])
+        self.eve  = eve
+        self.corp = corp
+        self.affiliation_ttl = datetime.timedelta(seconds=affiliation_ttl)
+
+        Names.__table__.create(self.db.engine, checkfirst=True)
+        add_missing_columns(self.db.engine, Names.__table__)
+
+    def lookup(self, kind, ids):
+        '''Returns {entityID: {'name', 'affiliationID', 'last_seen', 'fetched'}} for the stored ids of one kind.'''
+
+        table = Names.__table__
+        found = {}
+        ids   = [id_ for id_ in set(ids) if id_]
+
+        for i in range(0, len(ids), 500):
+            query = select([table.c.entityID, table.c.name, table.c.affiliationID, table.c.last_seen, table.c.fetched]).where(
+                    and_(table.c.kind == kind, table.c.entityID.in_(ids[i:i + 500])))
+
+            for row in self.db.engine.execute(query):
+                found[row.entityID] = {'name':row.name, 'affiliationID':row.affiliationID, 'last_seen':row.last_seen,
+                                       'fetched':row.fetched}
+
+        return found
+
+    def store(self, entries):
+        with self.db.engine.begin() as conn:
+            store_names(conn, entries)
+
+    def character_name(self, character_id):
+        entry = self.lookup('character', [character_id]).get(character_id)
+
+        return entry['name'] if entry else None
+
+    def corp_name_for_character(self, character_id):
+        entry = self.lookup('character', [character_id]).get(character_id)
+
+        if not entry or not entry['affiliationID']:
+            return None
+
+        corp = self.lookup('corporation', [entry['affiliationID']]).get(entry['affiliationID'])
+
+        return corp['name'] if corp else None
+
+    def alliance_name_for_corp(self, corp_id):
+        entry = self.lookup('corporation', [corp_id]).get(corp_id)
+
+        if not entry or not entry['affiliationID']:
+            return None
+
+        alliance = self.lookup('alliance', [entry['affiliationID']]).get(entry['affiliationID'])
+
+        return alliance['name'] if alliance else None
+
+    def fetch_affiliations(self, character_ids):
+        '''One CharacterAffiliation call per chunk_size characters, stored as character, corporation
+           and alliance names.'''
+
+        now     = datetime.datetime.utcnow()
+        entries = []
+
+        for i in range(0, len(character_ids), self.chunk_size):
+            chunk = character_ids[i:i + self.chunk_size]
+
+            try:
+                result = self.eve.affiliations_for_characters(chunk).result
+
+            except Exception as ex:
+                logging.warning('[names_utils] affiliations_for_characters failed for %s ids: %s' % (len(chunk), ex))
+                continue
+
+            for character_id, row in result.items():
+                alliance = row.get('alliance') or {}
+
+                entries.append((character_id, 'character', row['name'], row['corp']['id'], now))
+
+                if row['corp']['id']:
+                    entries.append((row['corp']['id'], 'corporation', row['corp']['name'], alliance.get('id'), now))
+
+                if alliance.get('id'):
+                    entries.append((alliance['id'], 'alliance', alliance['name'], None, now))
+
+        self.store(entries)
+
+    def fetch_corporation(self, corp_id):
+        '''Corporations have no batched call, only used for corps none of the characters are in.'''
+
+        now = datetime.datetime.utcnow()
+
+        try:
+            sheet = self.corp.corporation_sheet(corp_id=corp_id).result
+
+        except Exception as ex:
+            logging.warning('[names_utils] corporation_sheet failed for %s: %s' % (corp_id, ex))
+            return
+
+        alliance = sheet.get('alliance') or {}
+        entries  = [(corp_id, 'corporation', sheet['name'], alliance.get('id'), now)]
+
+        if alliance.get('id'):
+            entries.append((alliance['id'], 'alliance', alliance['name'], None, now))
+
+        self.store(entries)
+
+    def resolve(self, character_ids=(), corporation_ids=()):
+        '''Resolves every ID a view needs up front: stored names first, then one batched API call
+           for the characters that are missing or were stored longer than affiliation_ttl ago.
+           Returns ResolvedNames.'''
+
+        character_ids   = set(id_ for id_ in character_ids if id_)
+        corporation_ids = set(id_ for id_ in corporation_ids if id_)
+        stale           = datetime.datetime.utcnow() - self.affiliation_ttl
+
+        characters = self.lookup('character', character_ids)
+        # Freshness is when the entry was written, not the kill it came from: a week old kill stored
+        # an hour ago doesn't send every page that shows it to the API
+        missing    = [id_ for id_ in character_ids if id_ not in characters or (characters[id_]['fetched'] or datetime.datetime.min) < stale]
+
+        if missing:
+            self.fetch_affiliations(missing)
+            characters = self.lookup('character', character_ids)
+
+        corporation_ids.update(entry['affiliationID'] for entry in characters.values() if entry['affiliationID'])
+        corporations = self.lookup('corporation', corporation_ids)
+
+        # Corporations are refreshed along with their members, a sheet is only pulled for ones never seen
+        unknown = [id_ for id_ in corporation_ids if id_ not in corporations]
+
+        for corp_id in unknown:
+            self.fetch_corporation(corp_id)
+
+        if unknown:
+            corporations = self.lookup('corporation', corporation_ids)
+
+        alliances = self.lookup('alliance', [entry['affiliationID'] for entry in corporations.values()])
+
+        return ResolvedNames(characters, corporations, alliances)
@@ -0,0 +1,98 @@
+import threading
+
+import numpy as np
+
+
+class PiProfit():
+    '''Input cost, output value and margin of every PI schematic in every system, from the latest
+       price snapshots. The schematic graph is turned into two (schematics x types) quantity
+       matrices once, after which a system is a price vector and the whole P0 -> P4 chain is two
+       matrix products.'''
+
+    def __init__(self, pi_utils, utils, cache_size=8):
+        self.pi_utils   = pi_utils
+        self.utils      = utils
+        self.cache_size = cache_size
+        self.cache      = {}
+        self.lock       = threading.Lock()
+
+        index = pi_utils.index
+
+        self.schematic_ids = sorted(schematic_id for schematic_id in index.schematics if index.output(schematic_id))
+        self.type_ids      = sorted(set(index.made_by) | set(index.used_in))
+
+        column = dict((type_id, i) for i, type_id in enumerate(self.type_ids))
+
+        self.inputs  = np.zeros((len(self.schematic_ids), len(self.type_ids)))
+        self.outputs = np.zeros((len(self.schematic_ids), len(self.type_ids)))
+
+        for row, schematic_id in enumerate(self.schematic_ids):
+            for type_id, quantity in index.inputs(schematic_id).items():
+                self.inputs[row, column[type_id]] = quantity
+
+            type_id, quantity = index.output(schematic_id)
+            self.outputs[row, column[type_id]] = quantity
+
+        self.output_ids   = [index.output(schematic_id)[0] for schematic_id in self.schematic_ids]
+        self.output_names = [utils.lookup_typename(type_id) for type_id in self.output_ids]
+
+    def price_matrix(self, system_prices):
+        '''(types x systems) array of prices, NaN where a system has no price for a type.'''
+
+        columns = [[type_prices.get(type_id, np.nan) for type_id in self.type_ids] for type_prices in system_prices]
+
+        return np.array(columns, dtype=float).reshape(len(system_prices), len(self.type_ids)).T
+
+    def compute(self, system_prices):
+        '''Returns (cost, value, margin) arrays of shape (schematics x systems). A schematic with any
+           unpriced input or output gets NaN rather than a misleadingly cheap total.'''
+
+        prices  = self.price_matrix(system_prices)
+        missing = np.isnan(prices)
+        known   = np.where(missing, 0.0, prices)
+
+        cost  = self.inputs @ known
+        value = self.outputs @ known
+
+        cost[((self.inputs > 0) @ missing) > 0]   = np.nan
+        value[((self.outputs > 0) @ missing) > 0] = np.nan
+
+        return cost, value, value - cost
+
+    def evaluate(self, systems, tiers):
+        '''Returns {system: [row, ...]} sorted by margin, best first. Results are cached per set of
+           price snapshots, so they're only recomputed after update.py --pi stores new prices.'''
+
+        key = tuple((system, self.pi_utils.latest_snapshots(system, tiers)) for system in systems)
+
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+
+        system_prices = [self.pi_utils.snapshot_prices(snapshot_ids) for system, snapshot_ids in key]
+
+        cost, value, margin = self.compute(system_prices)
+        results = {}
+
+        for col, system in enumerate(systems):
+            rows = []
+
+            for row, schematic_id in enumerate(self.schematic_ids):
+                rows.append({'schematic_id':schematic_id,
+                             'type_id':self.output_ids[row],
+                             'name':self.output_names[row],
+                             'cost':None if np.isnan(cost[row, col]) else float(cost[row, col]),
+                             'value':None if np.isnan(value[row, col]) else float(value[row, col]),
+                             'margin':None if np.isnan(margin[row, col]) else float(margin[row, col])})
+
+            # Unknown margins go last
+            rows.sort(key=lambda r: (r['margin'] is None, -(r['margin'] or 0)))
+            results[system] = rows
+
+        with self.lock:
+            if len(self.cache) >= self.cache_size:
+                self.cache.pop(next(iter(self.cache)))
+
+            self.cache[key] = results
+
+        return results
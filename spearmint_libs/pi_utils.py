@@ -4,7 +4,9 @@ import datetime
 import logging  
 import json
 
-from sqlalchemy import create_engine,  Table, Column, Integer, String, Time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from sqlalchemy import create_engine,  Table, Column, Integer, String, Time, select, and_, func
 from sqlalchemy.orm import mapper, Session, load_only, sessionmaker
 from sqlalchemy.ext.automap import automap_base
 
@@ -12,7 +14,67 @@ import requests
 
 from spearmint_libs.utils import Utils
 from spearmint_libs.sql.db_connect import Connect
+from spearmint_libs.sql import add_missing_columns
+from spearmint_libs.sql.pi import Pi, PiSnapshot
+
+
+
+class PiIndex():
+    '''In-memory view of planetSchematicsTypeMap and constants/planet_materials.json.
+
+       tier_ids          {tier: [typeID, ...]} in SDE order, same as get_tiers_id always returned
+       schematics        {schematicID: {'inputs':{typeID: quantity}, 'output':(typeID, quantity)}}
+       made_by           {typeID: schematicID} for every PI product
+       used_in           {typeID: [schematicID, ...]}
+       planet_types      {material name: [planet type, ...]}
+       material_planets  {typeID: [planet type, ...]} for the materials the SDE knows by name'''
+
+    def __init__(self, schematic_rows, planet_materials, tiers, utils):
+        self.tier_ids         = {}
+        self.schematics       = {}
+        self.made_by          = {}
+        self.used_in          = {}
+        self.planet_types     = dict(planet_materials)
+        self.material_planets = {}
+
+        # Tiers are told apart by the quantity a schematic uses or makes of them
+        tier_for_quantity = dict((quantity, tier) for tier, quantity in tiers.items())
+
+        for schematic_id, type_id, quantity, is_input in schematic_rows:
+            schematic = self.schematics.setdefault(schematic_id, {'inputs':{}, 'output':None})
+
+            if is_input:
+                schematic['inputs'][type_id] = quantity
+                self.used_in.setdefault(type_id, []).append(schematic_id)
+
+            else:
+                schematic['output'] = (type_id, quantity)
+                self.made_by[type_id] = schematic_id
 
+            if quantity in tier_for_quantity:
+                self.tier_ids.setdefault(tier_for_quantity[quantity], {})[type_id] = None
+
+        self.tier_ids = dict((tier, list(ids)) for tier, ids in self.tier_ids.items())
+
+        for material, planets in planet_materials.items():
+            type_id = utils.lookup_typeid(material)
+
+            if type_id:
+                self.material_planets[type_id] = planets
+
+    def inputs(self, schematic_id):
+        return self.schematics[schematic_id]['inputs']
+
+    def output(self, schematic_id):
+        return self.schematics[schematic_id]['output']
+
+    def planets_for(self, material):
+        '''Planet types a P0 material can be extracted on, by name or typeID.'''
+
+        if material in self.material_planets:
+            return self.material_planets[material]
+
+        return self.planet_types.get(material, [])
 
 
 class PiUtils():
@@ -25,83 +87,221 @@ class PiUtils():
         # The key is the "usual" tier, the value is the database value
         self.tiers  = {0:3000, 1:40, 2:5, 3:3}
         self.ec_url = 'http://api.eve-central.com/api/marketstat'
+        # typeIDs asked for in a single marketstat request
+        self.ec_batch_size = 20
         self.utils  = utils_obj
 
-        self.ccp_db = Connect(config['database']['ccp_dump'])
+        self.ccp_db = self.utils.db
         
 
         material_file_path = '%s/constants/planet_materials.json' % (config['general']['base_dir'])
         
         with open(material_file_path) as material_file:
             planet_materials = json.load(material_file)
+
+        # Everything about PI that comes from the SDE or constants/, read once
+        schematic_map = self.ccp_db.base.classes.planetSchematicsTypeMap
+        rows = self.ccp_db.session.query(schematic_map.schematicID, schematic_map.typeID, schematic_map.quantity, schematic_map.isInput).all()
+
+        self.index = PiIndex(rows, planet_materials, self.tiers, self.utils)
         
 
     def get_tiers_id(self, tier):
         '''Returns the typeIDs associated with PI, from the given tier.'''
-        ids = []
 
-        q = self.ccp_db.session.query(self.ccp_db.base.classes.planetSchematicsTypeMap).filter_by(quantity=self.tiers[tier])
+        return self.index.tier_ids.get(tier) or False
 
-        for row in q.all():
-            to_append = row.typeID
-            # Prevent duplicates
-            if to_append not in ids:
-                ids.append(to_append)
-        
-        if len(ids):
-            return ids
+    def ensure_snapshots(self):
+        '''Adds pi_snapshots and pi.snapshot_id to databases that predate them, and files the rows
+           stored before then under snapshots made from their (system, tier, date).'''
+
+        PiSnapshot.__table__.create(self.db.engine, checkfirst=True)
+        add_missing_columns(self.db.engine, Pi.__table__)
+
+        pi_table       = Pi.__table__
+        snapshot_table = PiSnapshot.__table__
+        time_format    = '%Y-%m-%d %H:%M:%S'
+
+        with self.db.engine.begin() as conn:
+            groups = conn.execute(select([pi_table.c.system, pi_table.c.tier, pi_table.c.date]).where(
+                     pi_table.c.snapshot_id == None).group_by(pi_table.c.system, pi_table.c.tier, pi_table.c.date).order_by(pi_table.c.date)).fetchall()
+
+            for system, tier, date in groups:
+                taken_at    = datetime.datetime.strptime(date, time_format) if date else None
+                snapshot_id = conn.execute(snapshot_table.insert(), {'taken_at':taken_at, 'system':system, 'tier':tier}).inserted_primary_key[0]
 
-        return False
+                conn.execute(pi_table.update().where(and_(pi_table.c.snapshot_id == None, pi_table.c.system == system,
+                             pi_table.c.tier == tier, pi_table.c.date == date)).values(snapshot_id=snapshot_id, iteration=snapshot_id))
+
+        return len(groups)
+
+    def latest_snapshot(self, tier, system):
+        snapshot_table = PiSnapshot.__table__
+
+        query = select([func.max(snapshot_table.c.id)]).where(and_(snapshot_table.c.system == system, snapshot_table.c.tier == tier))
+
+        return self.db.session.execute(query).scalar()
 
     def get_prices(self, tier, system):
 
         '''Returns a sqlalchemy "Pi" object with the prices from the database'''
 
-        latest_entry = self.db.session.query(self.classes.pi.date).order_by(self.classes.pi.date.desc()).filter_by(tier=tier).first()
+        # Databases that haven't been through update.py --migrate yet
+        if 'pi_snapshots' not in self.classes:
+            latest_entry = self.db.session.query(self.classes.pi.date).order_by(self.classes.pi.date.desc()).filter_by(tier=tier).first()
 
-        query = self.db.session.query(self.classes.pi).filter_by(system=system, tier=tier, date=latest_entry.date).all()
+            query = self.db.session.query(self.classes.pi).filter_by(system=system, tier=tier, date=latest_entry.date).all()
 
-        return query or None
+            return query or None
 
+        snapshot_id = self.latest_snapshot(tier, system)
 
-    def store_prices(self, tier, system):
-        '''This obviously stores prices in the database. Everytime it runs, it increments the "iteration" \
-           integer from the database so I can keep things organized a little bit better.'''
+        if snapshot_id is None:
+            return None
+
+        return self.db.session.query(self.classes.pi).filter_by(snapshot_id=snapshot_id).all() or None
+
+    def latest_snapshots(self, system, tiers):
+        '''Returns the newest snapshotID of each tier that has one.'''
+
+        if 'pi_snapshots' not in self.classes:
+            return ()
+
+        snapshot_ids = [self.latest_snapshot(tier, system) for tier in tiers]
+
+        return tuple(snapshot_id for snapshot_id in snapshot_ids if snapshot_id is not None)
+
+    def snapshot_prices(self, snapshot_ids):
+        '''Returns {typeID: price} for the given snapshots.'''
+
+        pi_table = Pi.__table__
+        prices   = {}
+
+        if not snapshot_ids:
+            return prices
+
+        query = select([pi_table.c.item, pi_table.c.price]).where(pi_table.c.snapshot_id.in_(snapshot_ids))
+
+        for item, price in self.db.session.execute(query):
+            type_id = self.utils.lookup_typeid(item)
+
+            if type_id and price is not None:
+                prices[type_id] = float(price)
+
+        return prices
+
+    def get_price_history(self, tier, system, snapshots=10):
+        '''Returns {item: [(taken_at, price), ...]} over the last snapshots snapshots of a system and
+           tier, oldest first, in a single query.'''
+
+        pi_table       = Pi.__table__
+        snapshot_table = PiSnapshot.__table__
+        history        = {}
+
+        if 'pi_snapshots' not in self.classes:
+            return history
+
+        latest = select([snapshot_table.c.id]).where(and_(snapshot_table.c.system == system, snapshot_table.c.tier == tier)).order_by(
+                 snapshot_table.c.id.desc()).limit(snapshots)
+
+        query = select([pi_table.c.item, snapshot_table.c.taken_at, pi_table.c.price]).select_from(
+                pi_table.join(snapshot_table, pi_table.c.snapshot_id == snapshot_table.c.id)).where(
+                pi_table.c.snapshot_id.in_(latest)).order_by(snapshot_table.c.id)
+
+        for item, taken_at, price in self.db.session.execute(query):
+            history.setdefault(item, []).append((taken_at, price))
+
+        return history
+
+    def fetch_prices(self, type_ids, system):
+        '''One marketstat request for several typeIDs. Returns {typeID: highest buy price}, or None
+           if eve-central didn't answer with a 200.'''
+
+        data = {'typeid':list(type_ids), 'usesystem':system}
+        page = requests.get(self.ec_url, params=data, stream=True)
+
+        if page.status_code != 200:
+            logging.warning('page.status_code is %s, expecting 200' % (page.status_code))
+            return None
 
-        ids    = self.get_tiers_id(tier)
         prices = {}
-        count  = 0
-        
- 
+        page.raw.decode_content = True
+
+        # Parse as the response streams in and drop each <type> once it's read
+        for event, elem in ET.iterparse(page.raw):
+            if elem.tag != 'type':
+                continue
+
+            buy = elem.find('buy')
+
+            if buy is not None and buy.find('max') is not None:
+                prices[int(elem.get('id'))] = buy.find('max').text
+
+            elem.clear()
+
+        return prices
+
+    def store_all_prices(self, systems, tiers, workers=4):
+        '''Fetches every tier for every system, ec_batch_size typeIDs per request and up to workers
+           requests at once, then stores the whole snapshot in one transaction. A system/tier with a
+           failed request is left out rather than stored half complete.'''
+
         # Store the time this iteration was cached
-        date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-        for id_ in ids:
-            count += 1
-            logging.info('storing PI information from system: %s, tier: %s -- %s of %s' % (system, tier, count, len(ids)))
-
-            item = self.utils.lookup_typename(id_)
-            data = {'typeid':id_, 'usesystem':system}
-            page = requests.get(self.ec_url, params=data)
-
-            if page.status_code != 200:
-                logging.warning('page.status_code is %s, expecting 200' % (page.status_code))
-                return False
-
-            root = ET.fromstring(page.text)
-            
-            for b in root.iter('buy'):
-                maximum = b.find('max').text
-                
-                to_store = self.classes.pi(
-                        tier=tier, 
-                        price=maximum, 
-                        system=system,
-                        item=item,
-                        date=date) 
-
-                self.db.session.add(to_store)
-                self.db.session.commit()
-                
-                break
-        
+        taken_at = datetime.datetime.now().replace(microsecond=0)
+        date     = taken_at.strftime('%Y-%m-%d %H:%M:%S')
+        jobs   = {}
+        failed = set()
+        rows   = []
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for tier in tiers:
+                ids = self.get_tiers_id(tier) or []
+
+                for system in systems:
+                    for i in range(0, len(ids), self.ec_batch_size):
+                        future = pool.submit(self.fetch_prices, ids[i:i + self.ec_batch_size], system)
+                        jobs[future] = (system, tier)
+
+            results = dict((key, {}) for key in jobs.values())
+
+            for future in as_completed(jobs):
+                system, tier = jobs[future]
+
+                try:
+                    prices = future.result()
+
+                except Exception as ex:
+                    logging.warning('unable to fetch PI prices for system: %s, tier: %s -- %s' % (system, tier, ex))
+                    prices = None
+
+                if prices is None:
+                    failed.add((system, tier))
+                    continue
+
+                results[(system, tier)].update(prices)
+
+        with self.db.engine.begin() as conn:
+            for (system, tier), prices in results.items():
+                if (system, tier) in failed or not prices:
+                    logging.warning('not storing PI prices for system: %s, tier: %s' % (system, tier))
+                    continue
+
+                names = self.utils.lookup_typenames(prices.keys())
+
+                logging.info('storing PI information from system: %s, tier: %s -- %s items' % (system, tier, len(prices)))
+
+                snapshot_id = conn.execute(PiSnapshot.__table__.insert(), {'taken_at':taken_at, 'system':system, 'tier':tier}).inserted_primary_key[0]
+
+                for type_id, price in prices.items():
+                    rows.append({'tier':tier, 'price':price, 'system':system, 'item':names.get(type_id), 'date':date,
+                                 'snapshot_id':snapshot_id, 'iteration':snapshot_id})
+
+            if rows:
+                conn.execute(Pi.__table__.insert(), rows)
+
+        return len(rows)
+
+    def store_prices(self, tier, system):
+        '''Stores the prices of one tier in one system, see store_all_prices.'''
+
+        return self.store_all_prices([system], [tier])
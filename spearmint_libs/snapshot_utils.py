@@ -0,0 +1,160 @@
+import os
+import time
+import pickle
+import logging
+import threading
+
+from spearmint_libs.sql.db_connect import private_dir
+
+
+class Snapshot():
+    def __init__(self, data, fetched, expires):
+        self.data    = data
+        self.fetched = fetched
+        self.expires = expires
+
+    def expired(self):
+        return time.time() >= self.expires
+
+    def age(self):
+        '''Seconds since the snapshot was taken.'''
+
+        return int(time.time() - self.fetched)
+
+
+class SnapshotUtils():
+    '''Keeps the last result of each registered EVE API call and refreshes it from a background
+       thread once its cachedUntil passes, so pages never wait on CCP unless there's no snapshot
+       at all yet. Concurrent refreshes of the same snapshot are coalesced into one API call.
+
+       Snapshots are pickled to path, which is created 0700; it's left unused unless it's owned by
+       this user and nobody else can write to it, unpickling runs code.'''
+
+    def __init__(self, path=None, retry=300, min_lifetime=60):
+        self.path         = path
+        self.retry        = retry
+        self.min_lifetime = min_lifetime
+        self.sources      = {}
+        self.snapshots    = {}
+        self.locks        = {}
+        self.lock         = threading.Lock()
+        self.wakeup       = threading.Event()
+        self.thread       = None
+
+        if self.path and not os.path.exists(self.path):
+            os.makedirs(self.path, mode=0o700)
+
+        if self.path and not private_dir(self.path):
+            logging.warning('[snapshot_utils] not keeping snapshots in %s, it is not a directory only this user can write to' % (self.path))
+            self.path = None
+
+    def register(self, name, fetch):
+        '''fetch is called with no arguments and returns an evelink APIResult.'''
+
+        self.sources[name]   = fetch
+        self.locks[name]     = threading.Lock()
+        self.snapshots[name] = self.load(name)
+
+    def snapshot_path(self, name):
+        return os.path.join(self.path, '%s.pickle' % (name))
+
+    def load(self, name):
+        if not self.path or not os.path.exists(self.snapshot_path(name)):
+            return None
+
+        try:
+            with open(self.snapshot_path(name), 'rb') as snapshot_file:
+                if os.fstat(snapshot_file.fileno()).st_uid != os.getuid():
+                    raise ValueError('%s is not ours' % (self.snapshot_path(name)))
+
+                return pickle.load(snapshot_file)
+
+        except Exception as ex:
+            logging.warning('[snapshot_utils] unable to load %s: %s' % (name, ex))
+            return None
+
+    def save(self, name, snapshot):
+        if not self.path:
+            return
+
+        # Write then rename, so another worker never reads half a file
+        temp_path = '%s.%s.tmp' % (self.snapshot_path(name), os.getpid())
+
+        with open(temp_path, 'wb') as snapshot_file:
+            pickle.dump(snapshot, snapshot_file)
+
+        os.replace(temp_path, self.snapshot_path(name))
+
+    def get(self, name):
+        '''Returns the current Snapshot, even an expired one; the background thread replaces it.'''
+
+        self.start()
+
+        snapshot = self.snapshots[name]
+
+        if snapshot is None:
+            return self.refresh(name)
+
+        if snapshot.expired():
+            self.wakeup.set()
+
+        return snapshot
+
+    def refresh(self, name):
+        with self.locks[name]:
+            snapshot = self.snapshots[name]
+
+            # Someone else refreshed it while we were waiting for the lock
+            if snapshot is not None and not snapshot.expired():
+                return snapshot
+
+            now = time.time()
+
+            try:
+                data = self.sources[name]()
+
+            except Exception as ex:
+                logging.warning('[snapshot_utils] unable to refresh %s: %s' % (name, ex))
+
+                if snapshot is None:
+                    raise
+
+                snapshot.expires = now + self.retry
+                return snapshot
+
+            expires  = getattr(data, 'expires', None) or now + self.retry
+            snapshot = Snapshot(data, now, max(expires, now + self.min_lifetime))
+
+            self.snapshots[name] = snapshot
+            self.save(name, snapshot)
+
+            logging.info('[snapshot_utils] refreshed %s, next refresh in %ss' % (name, int(snapshot.expires - now)))
+
+            return snapshot
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            for name in list(self.sources):
+                snapshot = self.snapshots[name]
+
+                if snapshot is None or snapshot.expired():
+                    try:
+                        self.refresh(name)
+
+                    except Exception:
+                        pass
+
+            expiries = [snapshot.expires for snapshot in self.snapshots.values() if snapshot is not None]
+            timeout  = max(1, min(expiries) - time.time()) if expiries else self.retry
+
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
@@ -1,7 +1,7 @@
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Time, DateTime, create_engine, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, Time, DateTime, Date, create_engine, ForeignKey, Boolean, Index, inspect
 from sqlalchemy.orm import Session, backref, relationship
 
 DBSession = scoped_session(sessionmaker())
@@ -12,5 +12,47 @@ def initialize_sql(engine):
     Base.metadata.bind = engine
     Base.metadata.create_all(engine)
 
+def add_missing_columns(engine, table):
+    '''ALTER TABLE ... ADD COLUMN for model columns an existing table doesn't have yet. Returns the
+       names of the columns added.'''
+
+    existing = [column['name'] for column in inspect(engine).get_columns(table.name)]
+    added    = []
+
+    for column in table.columns:
+        if column.name in existing:
+            continue
+
+        column_type = column.type.compile(engine.dialect)
+        engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, column_type))
+        added.append('%s.%s' % (table.name, column.name))
+
+    return added
+
+def migrate_sql(engine):
+    '''Brings an existing database up to date with the models: creates missing tables and columns,
+       then the indexes that create_all skips on tables that already exist. Returns what was created.'''
+
+    created = []
+    existing_tables = inspect(engine).get_table_names()
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            table.create(engine)
+            created.append(table.name)
+
+        else:
+            created.extend(add_missing_columns(engine, table))
+
+    for table in Base.metadata.sorted_tables:
+        existing_indexes = [index['name'] for index in inspect(engine).get_indexes(table.name)]
+
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(engine)
+                created.append(index.name)
+
+    return created
+
 Base = declarative_base()
 
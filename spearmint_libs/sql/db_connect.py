@@ -1,12 +1,178 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+import os
+import pickle
+import hashlib
+import logging
+import threading
+
+import sqlalchemy
+
+from sqlalchemy import create_engine, MetaData
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.automap import automap_base
 
 
+# One Database per URL (and table list) for the whole process, see Connect
+_databases = {}
+_lock      = threading.Lock()
+
+
+def engine_options(db_path):
+    if db_path.startswith('sqlite'):
+        if db_path in ('sqlite://', 'sqlite:///:memory:'):
+            return {}
+
+        # The pool hands connections to whichever thread serves the request
+        return {'poolclass':QueuePool, 'pool_size':5, 'max_overflow':10, 'connect_args':{'check_same_thread':False}}
+
+    return {'pool_size':5, 'max_overflow':10, 'pool_recycle':3600, 'pool_pre_ping':True}
+
+
+def sqlite_file(db_path):
+    url = make_url(db_path)
+
+    if url.drivername.startswith('sqlite') and url.database not in (None, '', ':memory:'):
+        return os.path.abspath(url.database)
+
+    return None
+
+
+def reflect(engine, tables=None):
+    metadata = MetaData()
+    only     = None
+
+    # A callable rather than the list itself, so a table missing from the database isn't an error
+    if tables:
+        only = lambda name, meta: name in tables
+
+    metadata.reflect(engine, only=only)
+
+    return metadata
+
+
+def private_dir(path):
+    '''True if path is a directory only this user can write to, the pickles in it get loaded.'''
+
+    try:
+        stat = os.stat(path)
+
+    except OSError:
+        return False
+
+    return os.path.isdir(path) and stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+def cached_reflect(engine, db_path, tables, cache_dir):
+    '''reflect() through a pickle in cache_dir, valid as long as the database file keeps the same
+       mtime and size. Anything but a SQLite file is reflected every time. cache_dir is created
+       0700, and nothing is read from it unless it's owned by this user and nobody else can
+       write to it, unpickling runs code.'''
+
+    path = sqlite_file(db_path)
+
+    if path is None or not os.path.exists(path):
+        return reflect(engine, tables)
+
+    stat       = os.stat(path)
+    key        = (path, stat.st_mtime_ns, stat.st_size, tables, sqlalchemy.__version__)
+    name       = hashlib.sha1(repr((path, tables)).encode('utf-8')).hexdigest()
+    cache_path = os.path.join(cache_dir, '%s.pickle' % (name))
+
+    if os.path.exists(cache_dir) and not private_dir(cache_dir):
+        logging.warning('[db_connect] not caching schemas in %s, it is not a directory only this user can write to' % (cache_dir))
+
+        return reflect(engine, tables)
+
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            if os.fstat(cache_file.fileno()).st_uid != os.getuid():
+                raise ValueError('%s is not ours' % (cache_path))
+
+            cached_key, metadata = pickle.load(cache_file)
+
+        if cached_key == key:
+            return metadata
+
+    except Exception:
+        pass
+
+    metadata = reflect(engine, tables)
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, mode=0o700)
+
+        # Write then rename, so another worker never reads half a file
+        temp_path = '%s.%s.tmp' % (cache_path, os.getpid())
+
+        with open(temp_path, 'wb') as cache_file:
+            pickle.dump((key, metadata), cache_file)
+
+        os.replace(temp_path, cache_path)
+
+    except Exception as ex:
+        logging.warning('[db_connect] unable to cache the schema of %s: %s' % (path, ex))
+
+    return metadata
+
+
+class Database():
+    def __init__(self, db_path, tables=None, cache_schema=None):
+        self.engine = create_engine(db_path, convert_unicode=True, **engine_options(db_path))
+
+        if cache_schema:
+            metadata = cached_reflect(self.engine, db_path, tables, cache_schema)
+
+        else:
+            metadata = reflect(self.engine, tables)
+
+        self.base = automap_base(metadata=metadata)
+        self.base.prepare()
+
+        # A session per thread, main.py removes it when the request is torn down
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+
+
+def get_database(db_path, tables=None, cache_schema=None):
+    key = (db_path, tables)
+
+    with _lock:
+        if key not in _databases:
+            _databases[key] = Database(db_path, tables, cache_schema)
+
+        return _databases[key]
+
+
+def remove_sessions():
+    '''Closes the current thread's session on every database, call it at the end of each request.'''
+
+    for database in list(_databases.values()):
+        database.session.remove()
+
+
+def dispose_engines():
+    '''Drops pooled connections, a forked worker mustn't share its parent's sockets or file handles.'''
+
+    for database in list(_databases.values()):
+        database.engine.dispose()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=dispose_engines)
+
+
 class Connect():
-    def __init__(self, db_path):
-        self.base   = automap_base()
-        self.engine = create_engine(db_path, convert_unicode=True)
+    '''Handle on a database URL. Every Connect for the same URL shares one pooled engine and one
+       reflected schema; session is a scoped_session, so each thread gets its own.
+
+       tables limits reflection (and base.classes) to the named tables. cache_schema is a directory
+       to pickle the reflected schema in, reused across processes until the database file changes.
+       Only meant for databases nothing writes to, like the SDE.'''
+
+    def __init__(self, db_path, tables=None, cache_schema=None):
+        database = get_database(db_path, tuple(tables) if tables else None, cache_schema)
 
-        self.base.prepare(self.engine, reflect=True)
-        self.session = Session(self.engine)
+        self.engine  = database.engine
+        self.base    = database.base
+        self.session = database.session
@@ -2,12 +2,19 @@ from spearmint_libs.sql import *
 
 class ItemsLost(Base):
     __tablename__ = "items_lost"
+    __table_args__ = (Index('ix_items_lost_killID', 'killID'),)
+
     id        = Column(Integer, primary_key=True)
     typeID    = Column(Integer)
     killID    = Column(Integer, ForeignKey('kills.killID'))
 
 class Attacker(Base):
     __tablename__ = 'attacker'
+    # LossesUtils filters on allianceID IN (...) and killTime, then groups on shipTypeID
+    __table_args__ = (Index('ix_attacker_alliance_time_ship', 'allianceID', 'killTime', 'shipTypeID'),
+                      Index('ix_attacker_character_time', 'characterID', 'killTime'),
+                      Index('ix_attacker_killID', 'killID'))
+
     id              = Column(Integer, primary_key=True)
     killID          = Column(Integer, ForeignKey('kills.killID'))
     weaponTypeID    = Column(Integer)
@@ -21,6 +28,9 @@ class Attacker(Base):
 
 class Kills(Base):
     __tablename__ = "kills"
+    __table_args__ = (Index('ix_kills_alliance_time_ship', 'allianceID', 'killTime', 'shipTypeID'),
+                      Index('ix_kills_character_time', 'characterID', 'killTime'))
+
     id         = Column(Integer, primary_key=True)
     shipTypeID = Column(Integer)
     killTime   = Column(DateTime)
@@ -30,6 +40,32 @@ class Kills(Base):
     corporationID = Column(Integer)
     corporationName = Column(String(255))
     items       = relationship('ItemsLost', backref='kills', lazy='dynamic')
-    attackers   = relationship('Attacker',  backref='kills', lazy='dynamic')
+    attackers   = relationship('Attacker',  backref='kills', lazy='dynamic', foreign_keys='Attacker.killID')
 
     
+# One row per alliance, written in the same transaction as the kills it describes
+class LossSync(Base):
+    __tablename__ = 'loss_sync'
+    id         = Column(Integer, primary_key=True)
+    allianceID = Column(Integer, unique=True)
+    killID     = Column(Integer)
+    killTime   = Column(DateTime)
+    page       = Column(Integer)
+    updated    = Column(DateTime)
+
+# Kills per day, alliance, character and ship, kept up to date by LossesUtils.store_kills. 'used' rows
+# come from attacker and 'lost' rows from kills, the same split as LossesUtils.query_total
+class ShipUsageDaily(Base):
+    __tablename__ = 'ship_usage_daily'
+    __table_args__ = (Index('ix_ship_usage_daily_key', 'day', 'allianceID', 'characterID', 'shipTypeID', 'kill_option', unique=True),
+                      Index('ix_ship_usage_daily_alliance', 'kill_option', 'allianceID', 'day', 'shipTypeID', 'count'),
+                      Index('ix_ship_usage_daily_character', 'kill_option', 'characterID', 'day'))
+
+    id          = Column(Integer, primary_key=True)
+    day         = Column(Date)
+    allianceID  = Column(Integer)
+    characterID = Column(Integer)
+    shipTypeID  = Column(Integer)
+    kill_option = Column(String(10))
+    count       = Column(Integer)
+
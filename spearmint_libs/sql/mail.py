@@ -0,0 +1,18 @@
+from spearmint_libs.sql import *
+
+# Outbound mail, written by request handlers and drained by EmailTools' worker. A message is due
+# once next_attempt has passed; the worker pushes next_attempt forward while it's sending one.
+class EmailQueue(Base):
+    __tablename__ = 'email_queue'
+    __table_args__ = (Index('ix_email_queue_status_next', 'status', 'next_attempt'),)
+
+    id           = Column(Integer, primary_key=True)
+    recipient    = Column(String(255))
+    subject      = Column(String(255))
+    body         = Column(String)
+    status       = Column(String(10))
+    attempts     = Column(Integer)
+    created      = Column(DateTime)
+    next_attempt = Column(DateTime)
+    sent         = Column(DateTime)
+    last_error   = Column(String(255))
@@ -0,0 +1,17 @@
+from spearmint_libs.sql import *
+
+# Names of characters, corporations and alliances. affiliationID is the corporation of a character
+# or the alliance of a corporation, as of last_seen (a kill time, or when CCP was asked). fetched is
+# when the row was last written, which is what NamesUtils.resolve judges freshness by.
+class Names(Base):
+    __tablename__ = 'names'
+    __table_args__ = (Index('ix_names_kind_entity', 'kind', 'entityID', unique=True),)
+
+    id            = Column(Integer, primary_key=True)
+    entityID      = Column(Integer)
+    kind          = Column(String(20))
+    name          = Column(String(255))
+    affiliationID = Column(Integer)
+    last_seen     = Column(DateTime)
+    fetched       = Column(DateTime)
+
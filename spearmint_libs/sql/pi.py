@@ -1,8 +1,20 @@
 from spearmint_libs.sql import *
 
+# One row per system and tier every time update.py --pi runs
+class PiSnapshot(Base):
+    __tablename__ = "pi_snapshots"
+    __table_args__ = (Index('ix_pi_snapshots_system_tier', 'system', 'tier', 'id'),)
+
+    id       = Column(Integer, primary_key=True)
+    taken_at = Column(DateTime)
+    system   = Column(Integer)
+    tier     = Column(Integer)
+
 # Class to store the info from eve-central
 class Pi(Base):
     __tablename__ = "pi"
+    __table_args__ = (Index('ix_pi_system_tier_snapshot', 'system', 'tier', 'snapshot_id'),
+                      Index('ix_pi_snapshot_item', 'snapshot_id', 'item'))
    
     id     = Column(Integer, primary_key=True)
     iteration = Column(Integer)
@@ -11,4 +23,5 @@ class Pi(Base):
     tier   = Column(Integer)
     price  = Column(Integer)
     date   = Column(String(100))
+    snapshot_id = Column(Integer, ForeignKey('pi_snapshots.id'))
 
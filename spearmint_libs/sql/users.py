@@ -5,6 +5,8 @@ class Character(Base):
     id           = Column(Integer, primary_key=True)
     character_id = Column(Integer)
     user_id      = Column(Integer, ForeignKey('users.id'))
+    name         = Column(String(255))
+    corp_id      = Column(Integer)
 
 
 class Users(Base):
@@ -20,6 +22,13 @@ class Users(Base):
     activation_timestamp = Column(DateTime)
     recovery_timestamp   = Column(DateTime)
 
+    # Written by update.py --sync-members
+    in_corp          = Column(Boolean)
+    api_valid        = Column(Boolean)
+    api_checked      = Column(DateTime)
+    api_cached_until = Column(DateTime)
+    api_error        = Column(String(255))
+
     characters = relationship('Character', backref='user', lazy='dynamic')
 
     def is_active(self):
@@ -1,4 +1,17 @@
+import datetime
+
+from collections import namedtuple
+
+from spearmint_libs.sql import add_missing_columns
 from spearmint_libs.sql.db_connect import Connect
+from spearmint_libs.sql.users import Users, Character
+from spearmint_libs.cache_utils import LRUCache
+
+
+# What Flask-Login keeps for a logged in user. Immutable, so a cached one can be shared between
+# requests and threads; changes go through User, which drops the cached copy.
+UserSnapshot = namedtuple('UserSnapshot', ['id', 'email', 'active'])
+
 
 class LoadUser():
     def __init__(self, user):
@@ -30,14 +43,76 @@ class User():
 
         self.db = Connect(self.config['database']['data'])
 
+        # Registration fills in the membership columns, which databases created before them lack
+        add_missing_columns(self.db.engine, Users.__table__)
+        add_missing_columns(self.db.engine, Character.__table__)
+
+        # load_user runs on every request, snapshots are kept per process for user_cache_ttl seconds.
+        # Another process's password change or activation shows up here once the entry expires.
+        self.snapshot_ttl = config['general'].get('user_cache_ttl', 300)
+        self.snapshots    = LRUCache(maxsize=config['general'].get('user_cache_size', 10000))
+
 
     def load_user(self, email):
+        '''One query on a cache miss, none on a hit.'''
+
+        found, snapshot = self.snapshots.get(email)
+
+        if not found:
+            users = self.db.base.classes.users
+            q = self.db.session.query(users.id, users.email, users.active).filter_by(email=email).first()
+
+            if not q:
+                return False
+
+            snapshot = UserSnapshot(q.id, q.email, q.active)
+            self.snapshots.set(email, snapshot, self.snapshot_ttl)
+
+        return LoadUser(snapshot)
+
+    def invalidate(self, email):
+        self.snapshots.delete(email)
+
+    def set_password(self, email, pw_hash):
+        q = self.lookup_user(email)
+
+        if not q:
+            return False
+
+        q.password = pw_hash
+        self.db.session.commit()
+        self.invalidate(email)
+
+        return True
+
+    def set_recovery_code(self, email, recovery_code):
         q = self.lookup_user(email)
 
         if not q:
             return False
 
-        return LoadUser(self.lookup_user(email))
+        q.recovery_code = recovery_code
+        q.recovery_timestamp = datetime.datetime.now()
+        self.db.session.commit()
+
+        return True
+
+    def activate(self, email, activation_code):
+        '''Activates the account if activation_code is the one it was sent. The code can't be
+           used twice.'''
+
+        q = self.lookup_user(email)
+
+        if not q or activation_code != q.activation_code or q.activation_code == 'NULL':
+            return False
+
+        q.activation_code = 'NULL'
+        q.active = True
+        q.activation_timestamp = datetime.datetime.now()
+        self.db.session.commit()
+        self.invalidate(email)
+
+        return True
 
     def lookup_user(self, email):
         q = self.db.session.query(self.db.base.classes.users).filter_by(email=email).first()
@@ -48,23 +123,21 @@ class User():
         return q
 
 
+    # The rows are written through the models: the reflected classes predate the columns
+    # __init__ adds until the next restart.
     def add_user(self, **kwargs):
-        new_user = self.db.base.classes.users(**kwargs)
-
-        self.db.session.add(new_user)
+        self.db.session.execute(Users.__table__.insert(), kwargs)
         self.db.session.commit()
 
 
-    def add_character(self, email, character_id):
+    def add_character(self, email, character_id, name=None, corp_id=None):
 
         q = self.lookup_user(email)
 
         if not q:
             return False
 
-        new_character = self.db.base.classes.characters(character_id=character_id)
-        q.characters_collection.append(new_character)
-        self.db.session.add(q)
+        self.db.session.execute(Character.__table__.insert(), {'user_id':q.id, 'character_id':character_id, 'name':name, 'corp_id':corp_id})
         self.db.session.commit()
 
 
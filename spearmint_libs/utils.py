@@ -2,10 +2,11 @@ import xml.etree.cElementTree as ET
 import datetime
 import hashlib
 import os
+import threading
 
-from sqlalchemy import create_engine, or_
-from sqlalchemy.orm import Session
-from sqlalchemy.ext.automap import automap_base
+from collections import namedtuple
+
+from spearmint_libs.sql.db_connect import Connect
 
 
 def generate_code():
@@ -23,40 +24,100 @@ def format_currency(amount):
     return '{:,.2f}'.format(amount)
 
 
+# The only SDE tables Spearmint reads, the rest of the dump isn't reflected
+SDE_TABLES = ['invTypes', 'mapSolarSystems', 'mapDenormalize', 'planetSchematicsTypeMap']
+
+SolarSystem = namedtuple('SolarSystem', ['solarSystemID', 'solarSystemName', 'regionID', 'constellationID', 'security'])
+
+
 class Utils():
     def __init__(self, config):
-        self.base = automap_base()
-        engine  = create_engine(config['database']['ccp_dump'], convert_unicode=True)
-        self.base.prepare(engine, reflect=True)
-        self.session = Session(engine)
+        self.db      = Connect(config['database']['ccp_dump'], tables=SDE_TABLES,
+                               cache_schema='%s/schema' % (config['general']['base_dir']))
+        self.base    = self.db.base
+        self.session = self.db.session
+
+        # invTypes and mapSolarSystems never change between SDE releases, so they're read once
+        # on first use and answered from memory afterwards
+        self.lock         = threading.Lock()
+        self.type_names   = None
+        self.type_ids     = None
+        self.type_ids_ci  = None
+        self.systems      = None
+
+    def load_types(self):
+        with self.lock:
+            if self.type_names is not None:
+                return
+
+            invTypes    = self.base.classes.invTypes
+            type_names  = {}
+            type_ids    = {}
+            type_ids_ci = {}
+
+            for type_id, type_name in self.session.query(invTypes.typeID, invTypes.typeName).order_by(invTypes.typeID):
+                type_names[type_id] = type_name
+
+                if type_name is None:
+                    continue
+
+                type_ids.setdefault(type_name, type_id)
+                type_ids_ci.setdefault(type_name.lower(), type_id)
 
+            self.type_ids    = type_ids
+            self.type_ids_ci = type_ids_ci
+            self.type_names  = type_names
+
+    def load_systems(self):
+        with self.lock:
+            if self.systems is not None:
+                return
+
+            table   = self.base.classes.mapSolarSystems
+            systems = {}
+
+            for row in self.session.query(table.solarSystemID, table.solarSystemName, table.regionID, table.constellationID,
+                                          table.security).order_by(table.solarSystemID):
+                systems.setdefault(row[1].lower(), SolarSystem(*row))
+
+            self.systems = systems
 
     def lookup_typename(self, id):
-        #Base.classes.invTypes is the table, typeName is the column
-        q = self.session.query(self.base.classes.invTypes.typeName).filter_by(typeID=id)
+        if self.type_names is None:
+            self.load_types()
+
+        return self.type_names.get(id)
 
-        result = q.first()
+    def lookup_typenames(self, ids):
+        '''Returns a {typeID: typeName} dictionary, typeIDs that don't exist are left out.'''
 
-        if result:
-            return result[0]
-    
-        return None
-    
-    def lookup_typeid(self, name):
-        q = self.session.query(self.base.classes.invTypes.typeID).filter_by(typeName=name)
+        if self.type_names is None:
+            self.load_types()
 
-        result = q.first()
+        return dict((id_, self.type_names[id_]) for id_ in ids if id_ in self.type_names)
 
-        if result:
-            return result[0]
+    def lookup_typeid(self, name, ignore_case=False):
+        if self.type_ids is None:
+            self.load_types()
 
-        return None
+        if ignore_case and name:
+            return self.type_ids_ci.get(name.lower())
+
+        return self.type_ids.get(name)
 
     def lookup_system(self, name):
-        query = self.session.query(self.base.classes.mapSolarSystems).filter(
-            self.base.classes.mapSolarSystems.solarSystemName.like(name))
-       
-        return query.first() or None
+        # LIKE wildcards can't be answered from the index, let SQLite deal with them
+        if '%' in name or '_' in name:
+            query = self.session.query(self.base.classes.mapSolarSystems).filter(
+                self.base.classes.mapSolarSystems.solarSystemName.like(name))
+
+            return query.first() or None
+
+        if self.systems is None:
+            self.load_systems()
+
+        # LIKE is case insensitive in SQLite
+        return self.systems.get(name.lower())
 
 
     def lookup_planets(self, solarSystemID):
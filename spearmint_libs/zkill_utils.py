@@ -0,0 +1,179 @@
+import json
+import time
+import queue
+import logging
+import threading
+
+import requests
+
+
+class ZKillUtils():
+    '''Pulls loss pages from zKillboard with a pool of fetcher threads and hands them to a single
+       writer (the calling thread) through a bounded queue, so the network and the database are
+       busy at the same time instead of taking turns.'''
+
+    # allianceID and page, general.zkill_url in config.json points it somewhere else
+    kb_url = 'https://zkillboard.com/api/kills/allianceID/%s/page/%s/'
+
+    def __init__(self, workers=4, queue_size=16, batch_size=1000, kb_url=None):
+        self.workers    = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.batch_size = max(1, batch_size)
+
+        if kb_url:
+            self.kb_url = kb_url
+
+    def fetch_page(self, alliance_id, page):
+        kb_url = self.kb_url % (alliance_id, page)
+
+        return json.loads(requests.get(kb_url).text)
+
+    def _fetcher(self, jobs, results):
+        while True:
+            job = jobs.get()
+
+            if job is None:
+                break
+
+            alliance_id, page = job
+
+            try:
+                data = self.fetch_page(alliance_id, page)
+
+            except Exception as ex:
+                logging.warning('[zkill_utils] unable to fetch alliance %s page %s: %s' % (alliance_id, page, ex))
+                data = None
+
+            # Blocks when the writer falls behind, which keeps the fetchers from running away with memory
+            results.put((alliance_id, page, data))
+
+    def ingest(self, start_pages, end_page, store, known=None, checkpoint=True):
+        '''Fetches pages for every alliance in start_pages (alliance_id -> first page) up to
+           end_page-1 and calls store(rows, sync) from this thread once at least batch_size kills
+           are buffered. store returns (kills written, rows written).
+
+           When known is given (incremental mode) each alliance is paged one page at a time and
+           stops at the first page where known(kill_ids) already has every kill. When checkpoint
+           is set, sync carries the last page of each alliance that is committed along with every
+           page before it, so a crashed backfill can pick up from there. Returns a stats dictionary.'''
+
+        jobs     = queue.Queue()
+        results  = queue.Queue(maxsize=self.queue_size)
+        stats    = {'pages':0, 'kills':0, 'rows':0, 'failed':0, 'write_time':0.0}
+        pending  = 0
+        buffer   = {'rows':[], 'ids':set(), 'pages':[]}
+
+        # Lowest page of each alliance that isn't committed yet, and the committed pages above it
+        watermark = dict(start_pages)
+        committed = dict((alliance_id, set()) for alliance_id in start_pages)
+
+        if known:
+            for alliance_id, page in start_pages.items():
+                if page < end_page:
+                    jobs.put((alliance_id, page))
+                    pending += 1
+
+        else:
+            # Same order as the old crawl, page N of every alliance before page N+1
+            for page in range(min(start_pages.values() or [end_page]), end_page):
+                for alliance_id, start_page in start_pages.items():
+                    if page >= start_page:
+                        jobs.put((alliance_id, page))
+                        pending += 1
+
+        threads = []
+
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._fetcher, args=(jobs, results))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        started = time.time()
+
+        while pending:
+            alliance_id, page, data = results.get()
+            pending -= 1
+
+            if data is None:
+                stats['failed'] += 1
+                continue
+
+            print('Alliance %s page %s (%s kills)' % (alliance_id, page, len(data)))
+
+            stats['pages'] += 1
+
+            if known:
+                kill_ids = set(row['killID'] for row in data) - buffer['ids']
+                new_ids  = kill_ids - known(kill_ids)
+
+                if new_ids and page + 1 < end_page:
+                    jobs.put((alliance_id, page + 1))
+                    pending += 1
+
+                elif not new_ids:
+                    print('Alliance %s is up to date' % (alliance_id))
+
+            buffer['rows'].extend(data)
+            buffer['ids'].update(row['killID'] for row in data)
+            buffer['pages'].append((alliance_id, page, data))
+
+            if len(buffer['rows']) >= self.batch_size:
+                self._flush(buffer, store, stats, watermark, committed, checkpoint)
+
+        if buffer['pages']:
+            self._flush(buffer, store, stats, watermark, committed, checkpoint)
+
+        for _ in threads:
+            jobs.put(None)
+
+        for thread in threads:
+            thread.join()
+
+        stats['elapsed'] = time.time() - started
+
+        return stats
+
+    def _flush(self, buffer, store, stats, watermark, committed, checkpoint):
+        sync = {}
+
+        for alliance_id, page, data in buffer['pages']:
+            state = sync.setdefault(alliance_id, {'page':None, 'killID':None, 'killTime':None})
+
+            for row in data:
+                if state['killID'] is None or row['killID'] > state['killID']:
+                    state['killID']   = row['killID']
+                    state['killTime'] = row['killTime']
+
+            committed[alliance_id].add(page)
+
+        if checkpoint:
+            for alliance_id in sync:
+                done   = committed[alliance_id]
+                before = watermark[alliance_id]
+
+                while watermark[alliance_id] in done:
+                    done.remove(watermark[alliance_id])
+                    watermark[alliance_id] += 1
+
+                if watermark[alliance_id] > before:
+                    sync[alliance_id]['page'] = watermark[alliance_id] - 1
+
+        started = time.time()
+        kills, rows = store(buffer['rows'], sync)
+
+        stats['write_time'] += time.time() - started
+        stats['kills']      += kills
+        stats['rows']       += rows
+
+        buffer['rows']  = []
+        buffer['ids']   = set()
+        buffer['pages'] = []
+
+    def report(self, stats):
+        elapsed    = stats['elapsed'] or 1e-9
+        write_time = stats['write_time'] or 1e-9
+
+        print('%s pages, %s kills (%s rows) stored, %s failed in %.1fs' % (stats['pages'], stats['kills'], stats['rows'], stats['failed'], stats['elapsed']))
+        print('%.2f pages/sec, %.2f kills/sec' % (stats['pages'] / elapsed, stats['kills'] / elapsed))
+        print('%.2f rows/sec written (%.1fs spent writing)' % (stats['rows'] / write_time, stats['write_time']))
@@ -1,6 +1,7 @@
 import argparse
 import json 
 import datetime
+import sys
 
 import requests
 
@@ -8,47 +9,105 @@ from sqlalchemy import *
 from sqlalchemy.orm import Session, sessionmaker
 
 from spearmint_libs.pi_utils     import PiUtils
+from spearmint_libs.losses_utils import LossesUtils
+from spearmint_libs.zkill_utils  import ZKillUtils
+from spearmint_libs.cache_utils  import inspect_cache_dir, prune_cache_dir
+from spearmint_libs.app_utils    import Lazy, CorpSheet, load_config
+from spearmint_libs.membership_utils import MembershipUtils
+from spearmint_libs.export_utils import EXPORT_FORMATS, export_chunks
+from spearmint_libs.emailtools   import EmailTools
 from spearmint_libs.utils  import Utils, format_time
+from spearmint_libs.sql import add_missing_columns
 from spearmint_libs.sql.db_connect import Connect
+from spearmint_libs.sql.losses import LossSync
+from spearmint_libs.sql.names  import Names
 
 import evelink
 
 
 
 class Command():
-    def __init__(self):
-        self.config = self.read_config()
-        self.utils  = Utils(self.config)
-        self.pi_utils = PiUtils(self.config, self.utils)
+    # Safety cap for --incremental when --losses isn't given
+    incremental_max_pages = 50
+
+    def __init__(self, argv=None, config_path='config.json'):
+        self.config = self.read_config(config_path)
+        # The SDE is only opened by the commands that need it
+        self.utils  = Lazy(lambda: Utils(self.config))
+        self.pi_utils = Lazy(lambda: PiUtils(self.config, self.utils))
         self.eve    = evelink.eve.EVE()
         self.corp_api = evelink.api.API(api_key=(self.config['corp_api']['key'], self.config['corp_api']['code']))
         self.corp     = evelink.corp.Corp(self.corp_api)
-        self.db       = Connect(self.config['database']['data'])
+        self.losses   = LossesUtils(self.config)
+        self.db       = self.losses.db
 
 
         parser = argparse.ArgumentParser()
         parser.add_argument('--pi',        help='update the PI cache',  action='store_true')
         parser.add_argument('--losses',    help='update the items and ships that have been destroyed', action='store', type=int)
-        parser.add_argument('--coalition', help='coalition or alliance for --losses', action='store', type=str)
+        parser.add_argument('--coalition', help='coalition for --export, the first one in config.json by default', action='store', type=str)
         parser.add_argument('--create-db', help='create the databases', action='store_true')
+        parser.add_argument('--migrate',   help='add missing tables and indexes to an existing database', action='store_true')
+        parser.add_argument('--rebuild-rollup', help='recompute the daily ship usage rollup from all stored losses', action='store_true')
+        parser.add_argument('--cache-stats', help='show what is in the on-disk web cache', action='store_true')
+        parser.add_argument('--prune-cache', help='remove expired entries from the on-disk web cache', action='store_true')
+        parser.add_argument('--cache-max-age', help='with --prune-cache, also remove entries older than this many days', action='store', type=int)
+        parser.add_argument('--cache-max-files', help='with --prune-cache, keep at most this many of the newest entries', action='store', type=int)
         parser.add_argument('--start',     help='page to start at for updating losses', action='store', type=int)
-        self.args = parser.parse_args()
+        parser.add_argument('--workers',   help='concurrent zKillboard, eve-central or EVE API requests for --losses, --pi and --sync-members', action='store', type=int, default=4)
+        parser.add_argument('--queue-size', help='pages allowed to wait for the database before fetchers block', action='store', type=int, default=16)
+        parser.add_argument('--incremental', help='only fetch pages until one has no new kills, up to --losses pages', action='store_true')
+        parser.add_argument('--resume',    help='continue each alliance from the last page committed by --losses', action='store_true')
+        parser.add_argument('--batch-size', help='kills written per transaction for --losses, rows read at a time for --export', action='store', type=int, default=1000)
+        parser.add_argument('--export',    help='write losses to this file, - for stdout', action='store', type=str)
+        parser.add_argument('--export-format', help='csv or ndjson, by default from the --export file extension', action='store', choices=sorted(EXPORT_FORMATS))
+        parser.add_argument('--days',      help='with --export, only the last this many days', action='store', type=int)
+        parser.add_argument('--ship',      help='with --export, only this ship type name', action='store', type=str)
+        parser.add_argument('--character-id', help='with --export, only this character', action='store', type=int)
+        parser.add_argument('--kills',     help='with --export, used (attackers) or lost (victims)', action='store', choices=['used', 'lost'], default='used')
+        parser.add_argument('--items',     help='with --export, export the items lost on those kills', action='store_true')
+        parser.add_argument('--sync-members', help="re-check users' API keys whose cachedUntil has passed and flag the ones out of the corp", action='store_true')
+        parser.add_argument('--sync-all',  help='with --sync-members, check every key regardless of cachedUntil', action='store_true')
+        parser.add_argument('--send-email', help='deliver the queued email that is due, for when the web app is not running', action='store_true')
+        parser.add_argument('--email-queue', help='show how many emails are queued, sent and failed', action='store_true')
+        self.args = parser.parse_args(argv)
+
+        if self.args.migrate:
+            self.migrate_databases()
+
+        if self.args.rebuild_rollup:
+            print('Rebuilding ship_usage_daily...')
+            self.losses.rebuild_rollup()
 
         if self.args.pi:
             self.update_pi()
 
-        if self.args.losses:
+        if self.args.losses or self.args.incremental:
             self.update_losses()
 
         if self.args.create_db:
             self.create_databases()
 
-    def read_config(self, path='config.json'):
-        with open(path) as cfg:
-            config = json.loads(cfg.read())
-            assert(config)
+        if self.args.export:
+            self.export_losses()
+
+        if self.args.sync_members:
+            self.sync_members()
+
+        if self.args.send_email:
+            self.send_email()
+
+        if self.args.email_queue or self.args.send_email:
+            self.email_queue()
 
-            return config
+        if self.args.prune_cache:
+            self.prune_cache()
+
+        if self.args.cache_stats or self.args.prune_cache:
+            self.cache_stats()
+
+    def read_config(self, path='config.json'):
+        return load_config(path)
 
     def display_completion(self, percentage):
         print(int(percentage))
@@ -56,105 +115,193 @@ class Command():
     def update_losses(self):
         print('Updating losses...')
 
-        losses      = self.db
-        items_lost_  = {}
         alliance_ids = []
-        alliances_requested = []
 
         for coalition in self.config['coalitions']:
             alliance_ids.extend(self.config['coalitions'][coalition])
 
-        if self.args.start:
-            start_page = self.args.start
+        # Older databases won't have the sync, names or rollup tables yet
+        LossSync.__table__.create(self.db.engine, checkfirst=True)
+        Names.__table__.create(self.db.engine, checkfirst=True)
+        add_missing_columns(self.db.engine, Names.__table__)
+
+        if self.losses.ensure_rollup():
+            print('Built ship_usage_daily from the existing losses')
+
+        sync_state  = self.losses.sync_state()
+        end_page    = self.args.losses or self.incremental_max_pages
+        start_page  = self.args.start or 0
+        start_pages = {}
+
+        for alliance_id in alliance_ids:
+            start_pages[alliance_id] = start_page
+
+            if self.args.resume and alliance_id in sync_state and sync_state[alliance_id].page is not None:
+                start_pages[alliance_id] = sync_state[alliance_id].page + 1
+
+            if alliance_id in sync_state:
+                print('Alliance %s newest kill %s at %s' % (alliance_id, sync_state[alliance_id].killID, sync_state[alliance_id].killTime))
+
+        zkill = ZKillUtils(workers=self.args.workers, queue_size=self.args.queue_size, batch_size=self.args.batch_size,
+                           kb_url=self.config['general'].get('zkill_url'))
+
+        if self.args.incremental:
+            stats = zkill.ingest(start_pages, end_page, self.losses.store_kills, known=self.losses.known_kill_ids, checkpoint=False)
 
         else:
-            start_page = 0
-
-        for count in range(start_page, self.args.losses):
-            print('Page %s of %s' % (count, self.args.losses))
-
-            for alliance_id in alliance_ids:
-
-                if alliance_id in alliances_requested:
-                    continue
-
-                alliances_requested.append(alliance_id)
-                print('Alliance %s' % (alliance_id))
-                kb_url =  'https://zkillboard.com/api/kills/allianceID/%s/page/%s/' % (alliance_id, count)
-                
-                data = json.loads(requests.get(kb_url).text)
-
-                for row in data:
-                    
-                    # I'm putting row_count up here because its possible to already have the kill in the db. 
-
-                    #self.display_completion(row_count)
-                    # 'killTime': '2014-09-19 21:27:00'
-                    time_format = '%Y-%m-%d %H:%M:%S'
-                    kill_time = datetime.datetime.strptime(row['killTime'], time_format)
-                    kill_id   = row['killID']
-                
-                    query = losses.session.query(losses.base.classes.kills).filter_by(killID=kill_id).first()
-
-                    if query:
-                        #print('killID already exists, skipping')
-                        continue
-   
-        
-                    kill = losses.base.classes.kills(killID=kill_id, 
-                             shipTypeID=row['victim']['shipTypeID'], 
-                             killTime=kill_time,
-                             characterID=row['victim']['characterID'],
-                             corporationID=row['victim']['corporationID'],
-                             corporationName=row['victim']['corporationName'],
-                             allianceID=row['victim']['allianceID'])
-
-
-                    for line in row['items']:
-                        #print('storing item: %s' % (self.utils.lookup_typename(line['typeID'])))
-                        item = losses.base.classes.items_lost(typeID=line['typeID'])
-                        kill.items_lost_collection.append(item)
-
-                    for line in row['attackers']:
-                        attacker = losses.base.classes.attacker(weaponTypeID=line['weaponTypeID'], 
-                                                                allianceID=line['allianceID'],
-                                                                corporationName=line['corporationName'],
-                                                                shipTypeID=line['shipTypeID'],
-                                                                characterName=line['characterName'],
-                                                                characterID=line['characterID'],
-                                                                allianceName=line['allianceName'])
-
-                        kill.attacker_collection.append(attacker)
-
-
-                    #print('storing ship: %s' % (self.utils.lookup_typename(row['victim']['shipTypeID'])))
-                
-                    losses.session.add(kill) 
-                    losses.session.commit()
-
-            alliances_requested = []        
+            stats = zkill.ingest(start_pages, end_page, self.losses.store_kills)
+
+        zkill.report(stats)
+
+        return stats
 
     def update_pi(self):
         print('updating PI statistics...')
 
+        # Older databases won't have pi_snapshots yet
+        self.pi_utils.ensure_snapshots()
+
+        systems = []
+
         for system_name in self.config['statistics']['pi_systems']:
-            system = self.utils.lookup_system(system_name).__dict__
+            systems.append(self.utils.lookup_system(system_name).solarSystemID)
+
+        stored = self.pi_utils.store_all_prices(systems, self.config['statistics']['pi_tiers'], workers=self.args.workers)
 
-            for tier in self.config['statistics']['pi_tiers']:
-                self.pi_utils.store_prices(tier, system['solarSystemID'])
-                
+        print('Stored %s prices' % (stored))
         print('Done')
 
+    def export_losses(self):
+        coalition = self.args.coalition or list(self.config['coalitions'].keys())[0]
+
+        if coalition not in self.config['coalitions']:
+            print('Unknown coalition %s' % (coalition))
+            return
+
+        export_format = self.args.export_format or self.args.export.rsplit('.', 1)[-1].lower()
+
+        if export_format not in EXPORT_FORMATS:
+            export_format = 'csv'
+
+        ship_id = None
+
+        if self.args.ship:
+            ship_id = self.utils.lookup_typeid(self.args.ship, ignore_case=True)
+
+            if not ship_id:
+                print('Ship %s not found' % (self.args.ship))
+                return
+
+        days_ago = None
+
+        if self.args.days:
+            days_ago = datetime.datetime.utcnow() - datetime.timedelta(days=self.args.days)
+
+        columns, rows = self.losses.export_rows(self.config['coalitions'][coalition], characterID=self.args.character_id,
+                                                shipTypeID=ship_id, days_ago=days_ago, kills=self.args.kills,
+                                                items=self.args.items, batch_size=self.args.batch_size)
+
+        out = sys.stdout if self.args.export == '-' else open(self.args.export, 'w', newline='')
+
+        try:
+            for chunk in export_chunks(export_format, columns, rows):
+                out.write(chunk)
+
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+        if out is not sys.stdout:
+            print('Exported %s losses to %s' % (coalition, self.args.export))
+
+    def cache_dir(self):
+        return '%s/cache' % (self.config['general']['base_dir'])
+
+    def cache_stats(self):
+        stats = inspect_cache_dir(self.cache_dir())
+
+        print('Cache directory: %s' % (self.cache_dir()))
+        print('Entries: %s (%.1f MB), %s expired, %s unreadable' % (stats['files'], stats['bytes'] / 1048576.0, stats['expired'], stats['unreadable']))
+
+        if stats['files']:
+            print('Oldest entry written %s, newest %s' % (format_time(stats['oldest']), format_time(stats['newest'])))
+
+    def prune_cache(self):
+        max_age = self.args.cache_max_age * 86400 if self.args.cache_max_age else None
+        removed = prune_cache_dir(self.cache_dir(), max_age=max_age, max_files=self.args.cache_max_files)
+
+        print('Removed %s cache entries' % (removed))
+
+    def sync_members(self):
+        corp_sheet = CorpSheet(self.corp, '%s/corp_sheet.json' % (self.config['general']['base_dir']))
+        membership = MembershipUtils(self.config, corp_sheet.id)
+
+        print('Checking API keys for %s...' % (corp_sheet.name))
+        stats = membership.sync(workers=self.args.workers, force=self.args.sync_all)
+
+        print('Checked %(keys)s keys of %(users)s users: %(in_corp)s in the corp, %(invalid)s invalid keys, %(errors)s errors' % stats)
+
+        for email in stats['left']:
+            print('Not in the corp: %s' % (email))
+
+    def send_email(self):
+        emailtools = EmailTools(self.config)
+        emailtools.ensure_table()
+
+        sent, failed = emailtools.send_queued()
+        emailtools.disconnect()
+
+        print('Sent %s emails, %s failed' % (sent, failed))
+
+    def email_queue(self):
+        emailtools = EmailTools(self.config)
+        emailtools.ensure_table()
+
+        depth = emailtools.queue_depth()
+
+        print('Email queue: %(queued)s queued (%(due)s due), %(sent)s sent, %(failed)s failed' % depth)
+
     def create_databases(self):
         # You must import the metadata file, then connect it to the engine, otherwise
         # it will create a db with no tables. 
         from spearmint_libs.sql import initialize_sql
-        from spearmint_libs.sql.losses import ItemsLost, Kills
+        from spearmint_libs.sql.losses import ItemsLost, Kills, LossSync, ShipUsageDaily
         from spearmint_libs.sql.users  import Users, Character
-        from spearmint_libs.sql.pi     import Pi
+        from spearmint_libs.sql.pi     import Pi, PiSnapshot
+        from spearmint_libs.sql.names  import Names
+        from spearmint_libs.sql.mail   import EmailQueue
 
         initialize_sql(self.db.engine)
 
+        # create_all leaves ship_usage_daily empty on a database that already has losses
+        if self.losses.ensure_rollup():
+            print('Built ship_usage_daily from the existing losses')
+
+    def migrate_databases(self):
+        from spearmint_libs.sql import migrate_sql
+        from spearmint_libs.sql.losses import ItemsLost, Kills, LossSync, ShipUsageDaily
+        from spearmint_libs.sql.users  import Users, Character
+        from spearmint_libs.sql.pi     import Pi, PiSnapshot
+        from spearmint_libs.sql.names  import Names
+        from spearmint_libs.sql.mail   import EmailQueue
+
+        print('Migrating %s...' % (self.config['database']['data']))
+
+        # Has to run before migrate_sql creates the table empty
+        if self.losses.ensure_rollup():
+            print('Created ship_usage_daily')
+
+        for name in migrate_sql(self.db.engine):
+            print('Created %s' % (name))
+
+        print('Filed %s old PI price sets under snapshots' % (self.pi_utils.ensure_snapshots()))
+
+        # Give the SQLite planner statistics for the new indexes
+        if self.db.engine.name == 'sqlite':
+            self.db.engine.execute('ANALYZE')
+
+        print('Done')
+
 
 
 if __name__ == '__main__':